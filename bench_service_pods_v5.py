@@ -0,0 +1,548 @@
+'''
+Banc de mesure du contrôleur watch_service_pods_v5.py.
+
+Un faux API-Server Kubernetes (serveur HTTP dans le processus du banc) sert
+les LIST et les WATCH des Services, des POD, des CriticalServices et des
+POD Templates, accepte la création et la destruction des POD et compte chaque
+appel. Le contrôleur est lancé dans un processus fils (les Watchers et
+handle_events y tournent dans des threads) et il est connecté à ce faux
+API-Server. Des scénarios synthétiques sont ensuite rejoués:
+
+- rollout: mise à jour progressive de tous les POD d'un namespace,
+- outage: destruction de tous les POD d'un namespace de CriticalServices,
+- large: cluster de 10000 POD répartis sur 20 namespaces, puis modifications.
+
+Pour chaque scénario, le banc affiche le débit (événements/s), le nombre
+d'appels à l'API-Server par événement, la latence p50/p99 entre la destruction
+du dernier POD d'un Service et la création de son POD par défaut, ainsi que la
+RSS maximale du processus contrôleur.
+
+--script permet de mesurer une autre copie du contrôleur, à condition qu'elle ait
+la même structure que watch_service_pods_v5.py (_init_clients(), _watchers(),
+_handle_event() et handle_events(q) appelable dans un thread, sans effet de bord à
+l'import): les versions précédentes du contrôleur ne peuvent pas être mesurées.
+Le faux API-Server ne connaît ni PATCH, ni les EndpointSlices, ni les Lease: la
+promotion des POD de réserve (warmPool), LAME_DETECTION=endpointslices et
+l'élection d'un leader ne sont pas mesurés.
+
+Usage: python bench_service_pods_v5.py [--scale N] [--debounce S] [--workers N] [--page-size N]
+                                        [--script controleur.py] [scénario ...]
+'''
+import os
+import re
+import sys
+import json
+import time
+import queue
+import bisect
+import argparse
+import resource
+import threading
+import importlib.util
+import multiprocessing
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+NAMESPACE = 'bench'
+TEMPLATE_NS = 'linux-mag'
+TEMPLATE_NAME = 'critical-service-pod-template'
+DEFAULT_POD_PREFIX = 'service-watcher'
+
+LIST_KINDS = {
+    'pods': 'PodList',
+    'services': 'ServiceList',
+    'podtemplates': 'PodTemplateList',
+    'criticalservices': 'CriticalServiceList',
+}
+
+ROUTES = [
+    re.compile(r'^/api/v1/(?:namespaces/(?P<ns>[^/]+)/)?(?P<res>pods|services|podtemplates)(?:/(?P<name>[^/]+))?$'),
+    re.compile(r'^/apis/mycrd\.com/v1/(?P<res>criticalservices)(?:/(?P<name>[^/]+))?$'),
+]
+
+
+class FakeCluster:
+    '''Etat du faux cluster: objets rangés par ressource et journal des
+       événements (un resourceVersion croissant par modification).'''
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.rv = 0
+        self.objects = {res: {} for res in LIST_KINDS}  # {ressource: {(namespace, nom): objet}}
+        self.log = []             # [(rv, ressource, namespace, nom, labels, ligne JSON)]
+        self.log_rvs = []         # resourceVersion des entrées du journal (pour bisect)
+        self.calls = Counter()    # {(verbe, ressource): nombre d'appels}
+        self.delivered = 0        # objets transmis au contrôleur (éléments de LIST et événements)
+        self.created_at = {}      # {(namespace, nom): instant de création par le contrôleur}
+
+    def _event(self, res, type, obj):
+        metadata = obj['metadata']
+        line = json.dumps({'type': type, 'object': obj}).encode() + b'\n'
+        self.log.append((self.rv, res, metadata.get('namespace'), metadata['name'], metadata.get('labels') or {}, line))
+        self.log_rvs.append(self.rv)
+        self.cond.notify_all()
+
+    def put(self, res, obj):
+        '''Ajoute ou remplace un objet et publie l'événement correspondant.'''
+        with self.cond:
+            self.rv += 1
+            metadata = obj['metadata']
+            metadata['resourceVersion'] = str(self.rv)
+            key = (metadata.get('namespace'), metadata['name'])
+            type = 'MODIFIED' if key in self.objects[res] else 'ADDED'
+            self.objects[res][key] = obj
+            self._event(res, type, obj)
+
+    def delete(self, res, namespace, name):
+        with self.cond:
+            obj = self.objects[res].pop((namespace, name), None)
+            if obj is None:
+                return None
+            self.rv += 1
+            obj['metadata']['resourceVersion'] = str(self.rv)
+            self._event(res, 'DELETED', obj)
+            return obj
+
+    def count(self, verb, res):
+        with self.cond:
+            self.calls[(verb, res)] += 1
+
+
+def _matches(namespace, name, labels, ns, label_selector, field_selector):
+    if ns is not None and namespace != ns:
+        return False
+    # Sélecteurs de labels "k=v", "k" (présence) et "!k" (absence)
+    for term in filter(None, label_selector.split(',')):
+        k, eq, v = term.partition('=')
+        if term.startswith('!'):
+            if term[1:] in labels:
+                return False
+        elif (labels.get(k) != v) if eq else (k not in labels):
+            return False
+    for term in filter(None, field_selector.split(',')):
+        k, _, v = term.partition('=')
+        if (k == 'metadata.name' and name != v) or (k == 'metadata.namespace' and namespace != v):
+            return False
+    return True
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    '''Sert le sous-ensemble de l'API Kubernetes utilisé par le contrôleur.'''
+    protocol_version = 'HTTP/1.1'
+    cluster = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _route(self):
+        url = urlparse(self.path)
+        for route in ROUTES:
+            match = route.match(url.path)
+            if match:
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                return match.group('res'), match.groupdict().get('ns'), match.group('name'), params
+        return None, None, None, None
+
+    def _send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_status(self, code, reason):
+        self._send_json(code, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure',
+                               'reason': reason, 'code': code, 'metadata': {}})
+
+    def do_GET(self):
+        res, ns, name, params = self._route()
+        if res is None:
+            return self._send_status(404, 'NotFound')
+        cluster = self.cluster
+        if name is not None:
+            cluster.count('get', res)
+            obj = cluster.objects[res].get((ns, name))
+            return self._send_json(200, obj) if obj is not None else self._send_status(404, 'NotFound')
+        if params.get('watch', '').lower() == 'true':
+            cluster.count('watch', res)
+            return self._watch(res, ns, params)
+
+        cluster.count('list', res)
+        label_selector = params.get('labelSelector', '')
+        field_selector = params.get('fieldSelector', '')
+        # Pagination: les objets sont triés par (namespace, nom) et le jeton "continue"
+        # est la clé du dernier objet de la page précédente
+        limit = int(params.get('limit') or 0)
+        after = tuple(params['continue'].split('/', 1)) if params.get('continue') else None
+        with cluster.cond:
+            keys = sorted((namespace or '', obj_name) for (namespace, obj_name), obj in cluster.objects[res].items()
+                          if _matches(namespace, obj_name, obj['metadata'].get('labels') or {}, ns, label_selector, field_selector))
+            if after is not None:
+                keys = keys[bisect.bisect_right(keys, after):]
+            metadata = {'resourceVersion': str(cluster.rv)}
+            if limit and len(keys) > limit:
+                keys = keys[:limit]
+                metadata['continue'] = '/'.join(keys[-1])
+            items = [cluster.objects[res][(namespace or None, obj_name)] for namespace, obj_name in keys]
+            body = {'kind': LIST_KINDS[res], 'apiVersion': 'v1', 'items': items, 'metadata': metadata}
+            data = json.dumps(body).encode()
+            cluster.delivered += len(items)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _watch(self, res, ns, params):
+        cluster = self.cluster
+        label_selector = params.get('labelSelector', '')
+        field_selector = params.get('fieldSelector', '')
+        deadline = time.monotonic() + int(params.get('timeoutSeconds', 300))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        with cluster.cond:
+            position = bisect.bisect_right(cluster.log_rvs, int(params.get('resourceVersion') or cluster.rv))
+        try:
+            while True:
+                with cluster.cond:
+                    while position >= len(cluster.log):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        cluster.cond.wait(remaining)
+                    entries = cluster.log[position:]
+                    position = len(cluster.log)
+                    lines = [line for _, entry_res, namespace, name, labels, line in entries
+                             if entry_res == res and _matches(namespace, name, labels, ns, label_selector, field_selector)]
+                    cluster.delivered += len(lines)
+                if lines:
+                    data = b''.join(lines)
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                    self.wfile.flush()
+                if time.monotonic() >= deadline:
+                    break
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        res, ns, name, params = self._route()
+        if res != 'pods' or name is not None:
+            return self._send_status(405, 'MethodNotAllowed')
+        self.cluster.count('create', res)
+        obj = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        key = (ns, obj['metadata']['name'])
+        if key in self.cluster.objects[res]:
+            return self._send_status(409, 'AlreadyExists')
+        obj['metadata']['namespace'] = ns
+        obj['status'] = {'phase': 'Pending'}
+        self.cluster.created_at[key] = time.monotonic()
+        self.cluster.put(res, obj)
+        self._send_json(201, obj)
+
+    def do_DELETE(self):
+        res, ns, name, params = self._route()
+        if res != 'pods' or name is None:
+            return self._send_status(405, 'MethodNotAllowed')
+        self.cluster.count('delete', res)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self.cluster.delete(res, ns, name) is None:
+            return self._send_status(404, 'NotFound')
+        self._send_json(200, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Success', 'metadata': {}})
+
+
+def _pod(namespace, name, labels, phase='Running'):
+    return {'apiVersion': 'v1', 'kind': 'Pod',
+            'metadata': {'name': name, 'namespace': namespace, 'labels': labels},
+            'spec': {'containers': [{'name': 'app', 'image': 'nginx:1.7.9'}]},
+            'status': {'phase': phase}}
+
+
+def _service(namespace, name):
+    return {'apiVersion': 'v1', 'kind': 'Service',
+            'metadata': {'name': name, 'namespace': namespace, 'labels': {'app': name}},
+            'spec': {'selector': {'app': name}, 'type': 'ClusterIP', 'ports': [{'port': 80}]}}
+
+
+def _critical_service(namespace, svc_name):
+    return {'apiVersion': 'mycrd.com/v1', 'kind': 'CriticalService',
+            'metadata': {'name': f"{namespace}-{svc_name}"},
+            'spec': {'namespace': namespace, 'matchLabels': [{'key': 'app', 'value': svc_name}]}}
+
+
+def _populate(cluster, namespaces, services, pods_per_svc, critical):
+    '''Crée "services" Services par namespace avec leurs POD; les "critical"
+       premiers Services de chaque namespace sont des CriticalServices.'''
+    cluster.put('podtemplates', {'apiVersion': 'v1', 'kind': 'PodTemplate',
+                                 'metadata': {'name': TEMPLATE_NAME, 'namespace': TEMPLATE_NS},
+                                 'template': {'spec': {'containers': [{'name': 'nginx', 'image': 'nginx:1.7.9'}]}}})
+    for namespace in namespaces:
+        for i in range(services):
+            name = f"svc-{i}"
+            cluster.put('services', _service(namespace, name))
+            for j in range(pods_per_svc):
+                cluster.put('pods', _pod(namespace, f"{name}-{j}", {'app': name}))
+            if i < critical:
+                cluster.put('criticalservices', _critical_service(namespace, name))
+
+
+def _run_controller(script, host, env, conn):
+    '''Processus fils: charge le contrôleur, le connecte au faux API-Server et
+       répond aux demandes de statistiques du banc.'''
+    os.environ.update(env)
+    from kubernetes import client
+
+    spec = importlib.util.spec_from_file_location('controller', script)
+    controller = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(controller)
+
+    configuration = client.Configuration()
+    configuration.host = host
+    client.Configuration.set_default(configuration)
+    controller._init_clients()
+
+    # Compte les événements traités et récupère la file de travail de handle_events
+    handled = [0]
+    works = []
+    handle_event = controller._handle_event
+
+    def counting_handle_event(event, work, *args):
+        if event.type not in ('RELIST', 'SYNCED'):
+            handled[0] += 1
+        if not works:
+            works.append(work)
+        return handle_event(event, work, *args)
+
+    controller._handle_event = counting_handle_event
+
+    q = queue.Queue()
+    for target, args in controller._watchers():
+        threading.Thread(target=target, args=(q,) + args, daemon=True).start()
+    threading.Thread(target=controller.handle_events, args=(q,), daemon=True).start()
+
+    while conn.recv() != 'stop':
+        work = works[0] if works else None
+        busy = q.qsize() > 0 or work is None or len(work) > 0 or bool(work._processing)
+        conn.send((handled[0], busy, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+class Bench:
+    '''Un faux API-Server et un contrôleur connecté, pour un scénario.'''
+
+    def __init__(self, args):
+        self.cluster = FakeCluster()
+        handler = type('Handler', (FakeApiHandler,), {'cluster': self.cluster})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.args = args
+        self.rss = 0
+
+    def start(self):
+        env = {
+            'METRICS_PORT': '0',
+            'LOG_LEVEL': 'ERROR',
+            'DEBOUNCE_DELAY': str(self.args.debounce),
+            'RECONCILE_WORKERS': str(self.args.workers),
+            'POD_NAME_PREFIX': DEFAULT_POD_PREFIX,
+            'POD_TEMPLATE': TEMPLATE_NAME,
+            'POD_TEMPLATE_NS': TEMPLATE_NS,
+            'LIST_PAGE_SIZE': str(self.args.page_size),
+        }
+        host = f"http://127.0.0.1:{self.server.server_address[1]}"
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_run_controller, args=(self.args.script, host, env, child_conn), daemon=True)
+        self.process.start()
+
+    def wait_idle(self, until=None, timeout=900):
+        '''Attend que le contrôleur ait traité tout ce que l'API-Server lui a
+           transmis, que sa file de travail soit vide et que "until" soit vrai.'''
+        deadline = time.monotonic() + timeout
+        stable = 0
+        while time.monotonic() < deadline:
+            self.conn.send('stats')
+            handled, busy, self.rss = self.conn.recv()
+            with self.cluster.cond:
+                delivered = self.cluster.delivered
+            if handled >= delivered and not busy and (until is None or until()):
+                stable += 1
+                if stable >= 3:
+                    return
+            else:
+                stable = 0
+            time.sleep(0.02)
+        raise RuntimeError("controller did not settle before the timeout")
+
+    def api_calls(self):
+        with self.cluster.cond:
+            return sum(n for (verb, res), n in self.cluster.calls.items() if verb != 'watch')
+
+    def stop(self):
+        self.conn.send('stop')
+        self.process.join(5)
+        self.server.shutdown()
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def _measure(bench, name, action, until=None):
+    '''Rejoue "action" (qui retourne le nombre d'événements produits) et mesure
+       le traitement par le contrôleur.'''
+    cluster = bench.cluster
+    calls = bench.api_calls()
+    with cluster.cond:
+        rv = cluster.rv
+    start = time.monotonic()
+    action()
+    bench.wait_idle(until)
+    elapsed = time.monotonic() - start
+    with cluster.cond:
+        events = cluster.rv - rv
+    calls = bench.api_calls() - calls
+    return {
+        'scenario': name,
+        'events': events,
+        'seconds': elapsed,
+        'events_per_sec': events / elapsed if elapsed else 0,
+        'api_calls': calls,
+        'api_calls_per_event': calls / events if events else 0,
+    }
+
+
+def scenario_rollout(bench, scale):
+    '''Remplace un à un les POD de tous les Services (création du nouveau POD,
+       passage à Running, destruction de l'ancien).'''
+    services = 50 * scale
+    _populate(bench.cluster, [NAMESPACE], services, 4, services)
+    bench.start()
+    bench.wait_idle()
+
+    def rollout():
+        for i in range(services):
+            name = f"svc-{i}"
+            for j in range(4):
+                bench.cluster.put('pods', _pod(NAMESPACE, f"{name}-{j}-v2", {'app': name}, 'Pending'))
+                bench.cluster.put('pods', _pod(NAMESPACE, f"{name}-{j}-v2", {'app': name}, 'Running'))
+                bench.cluster.delete('pods', NAMESPACE, f"{name}-{j}")
+
+    return _measure(bench, 'rollout', rollout)
+
+
+def scenario_outage(bench, scale):
+    '''Détruit tous les POD d'un namespace dont tous les Services sont critiques:
+       chaque Service doit recevoir un POD par défaut.'''
+    services = 100 * scale
+    _populate(bench.cluster, [NAMESPACE], services, 2, services)
+    bench.start()
+    bench.wait_idle()
+
+    deleted_at = {}
+
+    def outage():
+        for i in range(services):
+            name = f"svc-{i}"
+            for j in range(2):
+                bench.cluster.delete('pods', NAMESPACE, f"{name}-{j}")
+            deleted_at[(NAMESPACE, f"{DEFAULT_POD_PREFIX}-{name}")] = time.monotonic()
+
+    def all_created():
+        return all(key in bench.cluster.created_at for key in deleted_at)
+
+    result = _measure(bench, 'outage', outage, all_created)
+    latencies = [bench.cluster.created_at[key] - t for key, t in deleted_at.items() if key in bench.cluster.created_at]
+    result['failover_p50_ms'] = _percentile(latencies, 50) * 1000
+    result['failover_p99_ms'] = _percentile(latencies, 99) * 1000
+    return result
+
+
+def scenario_large(bench, scale):
+    '''Cluster de 10000 POD (20 namespaces de 25 Services de 20 POD) puis
+       1000 modifications de POD. Le temps de synchronisation initiale est
+       aussi mesuré.'''
+    namespaces = [f"{NAMESPACE}-{i}" for i in range(20)]
+    _populate(bench.cluster, namespaces, 25 * scale, 20, 2)
+    start = time.monotonic()
+    bench.start()
+    bench.wait_idle()
+    sync_seconds = time.monotonic() - start
+
+    def churn():
+        for i in range(1000 * scale):
+            namespace = namespaces[i % len(namespaces)]
+            name = f"svc-{i % (25 * scale)}"
+            bench.cluster.put('pods', _pod(namespace, f"{name}-{i % 20}", {'app': name}, 'Running'))
+
+    result = _measure(bench, 'large', churn)
+    result['sync_seconds'] = sync_seconds
+    return result
+
+
+SCENARIOS = {
+    'rollout': scenario_rollout,
+    'outage': scenario_outage,
+    'large': scenario_large,
+}
+
+
+def _report(results):
+    columns = [
+        ('scenario', '{}', 'scenario'),
+        ('events', '{}', 'events'),
+        ('events_per_sec', '{:.0f}', 'events/s'),
+        ('api_calls_per_event', '{:.3f}', 'API calls/event'),
+        ('failover_p50_ms', '{:.1f}', 'failover p50 (ms)'),
+        ('failover_p99_ms', '{:.1f}', 'failover p99 (ms)'),
+        ('sync_seconds', '{:.2f}', 'initial sync (s)'),
+        ('peak_rss_mb', '{:.1f}', 'peak RSS (MB)'),
+    ]
+    rows = [[title for _, _, title in columns]]
+    for result in results:
+        rows.append([fmt.format(result[key]) if result.get(key) is not None else '-' for key, fmt, _ in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the v5 Service watcher against a fake API-server")
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"scenarios to run among {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--scale', type=int, default=1, help="size multiplier of every scenario")
+    parser.add_argument('--debounce', type=float, default=0.05, help="DEBOUNCE_DELAY given to the controller")
+    parser.add_argument('--workers', type=int, default=4, help="RECONCILE_WORKERS given to the controller")
+    parser.add_argument('--page-size', type=int, default=500, help="LIST_PAGE_SIZE given to the controller")
+    parser.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'watch_service_pods_v5.py'),
+                        help="copy of watch_service_pods_v5.py to benchmark (earlier controllers are not supported)")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario: {name}")
+
+    results = []
+    for name in args.scenarios or list(SCENARIOS):
+        bench = Bench(args)
+        try:
+            result = SCENARIOS[name](bench, args.scale)
+        finally:
+            bench.stop()
+        result['peak_rss_mb'] = bench.rss / 1024
+        results.append(result)
+        print(f"{name}: done in {result['seconds']:.2f}s", file=sys.stderr)
+    _report(results)
+
+
+if __name__ == '__main__':
+    main()
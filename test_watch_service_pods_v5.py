@@ -0,0 +1,234 @@
+'''
+Tests unitaires des structures de watch_service_pods_v5.py qui ne dépendent pas
+de l'API-Server: file de travail, index des Services et des CriticalServices,
+anneau de hachage du mode "sharding".
+
+Usage: python -m unittest test_watch_service_pods_v5 (ou python -m pytest)
+'''
+import os
+import time
+import threading
+import unittest
+
+os.environ.setdefault('METRICS_PORT', '0')
+
+import watch_service_pods_v5 as v5
+
+
+def _service(namespace, name, selector, svc_type='ClusterIP', labels=None):
+    return v5.ObjectRecord(namespace, name, '1', labels, selector=selector, svc_type=svc_type)
+
+
+def _pod(namespace, name, labels, owned=False):
+    return v5.PodRecord(namespace, name, '1', labels, 'Running', True, owned)
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def test_keys_are_deduplicated(self):
+        work = v5.WorkQueue(0)
+        work.add('ns/a')
+        work.add('ns/a')
+        self.assertEqual(len(work), 1)
+        self.assertEqual(work.get(), 'ns/a')
+        self.assertEqual(len(work), 0)
+
+    def test_key_waits_for_the_delay(self):
+        work = v5.WorkQueue(0.2)
+        work.add('ns/a')
+        key, timeout = work._try_get()
+        self.assertIsNone(key)
+        self.assertGreater(timeout, 0)
+        start = time.monotonic()
+        self.assertEqual(work.get(), 'ns/a')
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def test_key_added_while_processing_is_requeued_by_done(self):
+        work = v5.WorkQueue(0)
+        work.add('ns/a')
+        self.assertEqual(work.get(), 'ns/a')
+        work.add('ns/a')
+        # La clé n'est pas confiée à un second worker pendant son traitement
+        self.assertEqual(work._try_get(), (None, None))
+        work.done('ns/a')
+        self.assertEqual(work.get(), 'ns/a')
+        work.done('ns/a')
+        self.assertEqual(len(work), 0)
+
+    def test_failed_key_backs_off_exponentially(self):
+        work = v5.WorkQueue(0, retry_delay=0.1, retry_max_delay=0.3)
+        work.add('ns/a')
+        for delay in (0.1, 0.2, 0.3, 0.3):
+            self.assertEqual(work.get(), 'ns/a')
+            work.done('ns/a', failed=True)
+            self.assertAlmostEqual(work._due['ns/a'] - time.monotonic(), delay, delta=0.05)
+
+        # Un succès remet le compteur d'échecs à zéro
+        self.assertEqual(work.get(), 'ns/a')
+        work.done('ns/a')
+        self.assertNotIn('ns/a', work._failures)
+        work.add('ns/a')
+        self.assertEqual(work.get(), 'ns/a')
+        work.done('ns/a', failed=True)
+        self.assertAlmostEqual(work._due['ns/a'] - time.monotonic(), 0.1, delta=0.05)
+
+    def test_failure_replaces_pending_add(self):
+        work = v5.WorkQueue(0, retry_delay=0.5)
+        work.add('ns/a')
+        work.get()
+        work.add('ns/a')
+        work.done('ns/a', failed=True)
+        self.assertEqual(len(work), 1)
+        self.assertEqual(work._try_get()[0], None)
+
+    def test_a_key_is_never_processed_concurrently(self):
+        work = v5.WorkQueue(0)
+        keys = [f"ns/{i}" for i in range(5)]
+        active = set()
+        overlaps = []
+        processed = []
+        lock = threading.Lock()
+        stop = time.monotonic() + 0.5
+
+        def worker():
+            while time.monotonic() < stop:
+                key = work.get()
+                with lock:
+                    if key in active:
+                        overlaps.append(key)
+                    active.add(key)
+                time.sleep(0.001)
+                with lock:
+                    active.discard(key)
+                    processed.append(key)
+                work.done(key)
+
+        def producer():
+            i = 0
+            while time.monotonic() < stop:
+                work.add(keys[i % len(keys)])
+                i += 1
+                time.sleep(0.0001)
+            # Débloque les workers encore en attente
+            for key in keys:
+                work.add(key)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(4)]
+        threads.append(threading.Thread(target=producer, daemon=True))
+        [t.start() for t in threads]
+        [t.join(5) for t in threads[-1:]]
+        self.assertEqual(overlaps, [])
+        self.assertTrue(processed)
+
+
+class SelectorIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = v5.SelectorIndex()
+        pods = [_pod('ns', 'p1', {'app': 'web', 'tier': 'front'}),
+                _pod('ns', 'p2', {'app': 'web'}),
+                _pod('ns', 'default', {'app': 'web', 'tier': 'front'}, owned=True)]
+        self.index.add_service(_service('ns', 'web', {'app': 'web'}), pods)
+        self.index.add_service(_service('ns', 'front', {'app': 'web', 'tier': 'front'}), pods)
+
+    def test_add_service_counts_selected_pods(self):
+        # Le POD par défaut d'une version précédente n'est pas compté
+        self.assertEqual(self.index.count('ns', 'web'), 2)
+        self.assertEqual(self.index.count('ns', 'front'), 1)
+        self.assertEqual(self.index.count('ns', 'unknown'), 0)
+
+    def test_services_without_selector_are_not_indexed(self):
+        self.index.add_service(_service('ns', 'ext', {'app': 'web'}, svc_type='ExternalName'), [])
+        self.index.add_service(_service('ns', 'none', None), [])
+        self.assertEqual(self.index.match('ns', {'app': 'web'}), {'web'})
+
+    def test_match_requires_the_whole_selector(self):
+        self.assertEqual(self.index.match('ns', {'app': 'web'}), {'web'})
+        self.assertEqual(self.index.match('ns', {'app': 'web', 'tier': 'front', 'x': 'y'}), {'web', 'front'})
+        self.assertEqual(self.index.match('other', {'app': 'web'}), set())
+
+    def test_update_pod(self):
+        self.assertEqual(self.index.update_pod('ns', None, {'app': 'web', 'tier': 'front'}), {'web', 'front'})
+        self.assertEqual(self.index.count('ns', 'web'), 3)
+        self.assertEqual(self.index.count('ns', 'front'), 2)
+
+        self.assertEqual(self.index.update_pod('ns', {'app': 'web', 'tier': 'front'}, {'app': 'web'}), {'web', 'front'})
+        self.assertEqual(self.index.count('ns', 'web'), 3)
+        self.assertEqual(self.index.count('ns', 'front'), 1)
+
+        self.assertEqual(self.index.update_pod('ns', {'app': 'web'}, None), {'web'})
+        self.assertEqual(self.index.count('ns', 'web'), 2)
+
+    def test_remove_service(self):
+        self.index.remove_service('ns', 'front')
+        self.assertEqual(self.index.match('ns', {'app': 'web', 'tier': 'front'}), {'web'})
+        self.assertEqual(self.index.count('ns', 'front'), 0)
+        self.assertNotIn(('ns', 'tier', 'front'), self.index._index)
+
+
+class CriticalServiceIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = v5.CriticalServiceIndex()
+
+    def test_service_named_after_a_critical_service(self):
+        self.index.set('web', {'namespace': 'ns', 'matchLabels': [{'key': 'x', 'value': 'y'}]})
+        self.assertTrue(self.index.is_critical(_service('ns', 'web', {})))
+        self.assertFalse(self.index.is_critical(_service('other', 'web', {})))
+
+    def test_match_labels_must_all_be_present(self):
+        self.index.set('crit', {'namespace': 'ns', 'matchLabels': [{'key': 'app', 'value': 'web'},
+                                                                   {'key': 'env', 'value': 'prod'}]})
+        self.assertEqual(self.index.matching(_service('ns', 's', {}, labels={'app': 'web', 'env': 'prod'})),
+                         {'crit'})
+        self.assertFalse(self.index.is_critical(_service('ns', 's', {}, labels={'app': 'web'})))
+        self.assertFalse(self.index.is_critical(_service('other', 's', {}, labels={'app': 'web', 'env': 'prod'})))
+
+    def test_empty_match_labels_match_the_whole_namespace(self):
+        self.index.set('all', {'namespace': 'ns', 'matchLabels': []})
+        self.assertTrue(self.index.is_critical(_service('ns', 's', {})))
+        self.assertFalse(self.index.is_critical(_service('other', 's', {})))
+
+    def test_contradictory_match_labels_never_match(self):
+        self.index.set('never', {'namespace': 'ns', 'matchLabels': [{'key': 'app', 'value': 'a'},
+                                                                    {'key': 'app', 'value': 'b'}]})
+        self.assertFalse(self.index.is_critical(_service('ns', 's', {}, labels={'app': 'a'})))
+        self.assertTrue(self.index.is_critical(_service('ns', 'never', {})))
+
+    def test_set_replaces_and_pop_cleans_up(self):
+        self.index.set('crit', {'namespace': 'ns', 'matchLabels': [{'key': 'app', 'value': 'web'}]})
+        self.index.set('crit', {'namespace': 'ns', 'matchLabels': []})
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index._index, {})
+        self.assertTrue(self.index.is_critical(_service('ns', 's', {})))
+
+        self.assertEqual(self.index.pop('crit'), {'namespace': 'ns', 'matchLabels': []})
+        self.assertIsNone(self.index.pop('crit'))
+        self.assertEqual((self.index._index, self.index._match_all, self.index._required), ({}, {}, {}))
+        self.assertFalse(self.index.is_critical(_service('ns', 's', {})))
+
+
+class HashRingTest(unittest.TestCase):
+
+    def test_empty_ring(self):
+        self.assertIsNone(v5.HashRing([], 8).owner('ns'))
+
+    def test_owner_is_stable_and_spread(self):
+        namespaces = [f"ns{i}" for i in range(200)]
+        ring = v5.HashRing(['a', 'b', 'c'], 64)
+        owners = {namespace: ring.owner(namespace) for namespace in namespaces}
+        self.assertEqual(owners, {namespace: v5.HashRing(['c', 'a', 'b'], 64).owner(namespace)
+                                  for namespace in namespaces})
+        self.assertEqual(set(owners.values()), {'a', 'b', 'c'})
+
+    def test_leaving_member_only_moves_its_namespaces(self):
+        namespaces = [f"ns{i}" for i in range(200)]
+        before = v5.HashRing(['a', 'b', 'c'], 64)
+        after = v5.HashRing(['a', 'b'], 64)
+        moved = [namespace for namespace in namespaces if before.owner(namespace) != after.owner(namespace)]
+        self.assertTrue(moved)
+        self.assertTrue(all(before.owner(namespace) == 'c' for namespace in moved))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,27 +9,78 @@ supprimé.
 '''
 import os
 import sys
+import json
+import time
+import zlib
+import heapq
+import bisect
+import pickle
+import pstats
+import hashlib
+import cProfile
+import contextvars
+import itertools
+import random
+import socket
+import asyncio
+import weakref
+import tempfile
+import threading
 import urllib3
 import logging
+from collections import deque
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process, Queue
-from kubernetes import client, config, watch
+from kubernetes import client, config
 from kubernetes.client import Configuration
 from kubernetes.client.rest import ApiException
+from urllib3.connection import HTTPConnection
 
-urllib3.disable_warnings()
+# Les LIST et les Watch sont décodés par orjson s'il est installé (bien plus rapide),
+# à défaut par le module json de la bibliothèque standard
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
-if len(sys.argv) > 1:
-    config.load_kube_config(sys.argv[1])
-else:
-    try:
-        config.load_kube_config()
-    except:
-        config.load_incluster_config()
+urllib3.disable_warnings()
 
 # Ces variables peuvent être surchargées via des variables d'environnement
 pod_name_prefix = os.environ['POD_NAME_PREFIX'] if 'POD_NAME_PREFIX' in os.environ else 'service-watcher'
 pod_template = os.environ['POD_TEMPLATE'] if 'POD_TEMPLATE' in os.environ else 'critical-service-pod-template'
 pod_template_ns = os.environ['POD_TEMPLATE_NS'] if 'POD_TEMPLATE_NS' in os.environ else 'linux-mag'
+watch_timeout = int(os.environ['WATCH_TIMEOUT']) if 'WATCH_TIMEOUT' in os.environ else 300
+watch_retry_delay = float(os.environ['WATCH_RETRY_DELAY']) if 'WATCH_RETRY_DELAY' in os.environ else 1.0
+# Après des erreurs successives, le délai avant de rouvrir un Watch double jusqu'à WATCH_RETRY_MAX_DELAY
+watch_retry_max_delay = float(os.environ['WATCH_RETRY_MAX_DELAY']) if 'WATCH_RETRY_MAX_DELAY' in os.environ else 30.0
+debounce_delay = float(os.environ['DEBOUNCE_DELAY']) if 'DEBOUNCE_DELAY' in os.environ else 0.5
+reconcile_workers = int(os.environ['RECONCILE_WORKERS']) if 'RECONCILE_WORKERS' in os.environ else 4
+# Ecritures vers l'API-Server (création, modification, destruction de POD): débit limité
+# à WRITE_QPS par seconde (rafales de WRITE_BURST), erreurs transitoires réessayées
+# WRITE_RETRIES fois avec un délai exponentiel. Une réconciliation qui échoue malgré tout
+# est reprise plus tard, avec un délai qui double jusqu'à RECONCILE_RETRY_MAX_DELAY.
+# Une écriture sans réponse après WRITE_REQUEST_TIMEOUT secondes est réessayée
+write_qps = float(os.environ['WRITE_QPS']) if 'WRITE_QPS' in os.environ else 20.0
+write_burst = int(os.environ['WRITE_BURST']) if 'WRITE_BURST' in os.environ else 50
+write_retries = int(os.environ['WRITE_RETRIES']) if 'WRITE_RETRIES' in os.environ else 5
+write_retry_delay = float(os.environ['WRITE_RETRY_DELAY']) if 'WRITE_RETRY_DELAY' in os.environ else 0.2
+write_retry_max_delay = float(os.environ['WRITE_RETRY_MAX_DELAY']) if 'WRITE_RETRY_MAX_DELAY' in os.environ else 10.0
+reconcile_retry_max_delay = float(os.environ['RECONCILE_RETRY_MAX_DELAY']) if 'RECONCILE_RETRY_MAX_DELAY' in os.environ else 60.0
+write_request_timeout = float(os.environ['WRITE_REQUEST_TIMEOUT']) if 'WRITE_REQUEST_TIMEOUT' in os.environ else 10.0
+# Chaque processus crée ses propres clients de l'API (après le fork): les Watch (LIST
+# initial et flux) et les autres requêtes (écritures, Lease, POD Template) ont chacun
+# leur pool de connexions HTTP, réutilisées d'une réconciliation à l'autre, de
+# WATCH_POOL_SIZE (par défaut une par Watcher, 32 en mode "sharding" où les Watchers
+# des namespaces sont lancés à la demande) et API_POOL_SIZE connexions.
+# API_KEEPALIVE (secondes, 0 pour le désactiver) règle le keep-alive TCP des connexions
+watch_pool_size = int(os.environ['WATCH_POOL_SIZE']) if 'WATCH_POOL_SIZE' in os.environ else 0
+api_pool_size = int(os.environ['API_POOL_SIZE']) if 'API_POOL_SIZE' in os.environ else reconcile_workers + 2
+api_keepalive = int(os.environ['API_KEEPALIVE']) if 'API_KEEPALIVE' in os.environ else 30
+# RUNTIME=process: un processus pour tous les Watchers (un thread par Watcher) et un
+# pour handle_events; RUNTIME=asyncio: un seul processus
+runtime = os.environ['RUNTIME'] if 'RUNTIME' in os.environ else 'process'
 log_level = os.environ['LOG_LEVEL'] if 'LOG_LEVEL' in os.environ else logging.WARNING
 try:
     logging.basicConfig(level=log_level)
@@ -42,269 +93,2542 @@ except Exception as e:
     logging.error(f"Bad value for environment variable NAMESPACES: {os.environ['NAMESPACES']}")
     ns = []
 
-v1 = client.CoreV1Api()
-custom_api = client.CustomObjectsApi()
+# Si des namespaces sont indiqués, un Watch par namespace est ouvert au lieu de filtrer
+# les événements de tout le cluster. Les selectors sont transmis à l'API-Server,
+# par exemple POD_FIELD_SELECTOR="status.phase!=Succeeded,status.phase!=Failed"
+namespaced_watches = os.environ.get('NAMESPACED_WATCHES', 'true').lower() in ('true', 'yes', '1')
+pod_label_selector = os.environ.get('POD_LABEL_SELECTOR', '')
+pod_field_selector = os.environ.get('POD_FIELD_SELECTOR', '')
+svc_label_selector = os.environ.get('SERVICE_LABEL_SELECTOR', '')
+svc_field_selector = os.environ.get('SERVICE_FIELD_SELECTOR', '')
+
+# LAME_DETECTION=pods: un Service est bancal si aucun POD ne correspond à son "selector";
+# LAME_DETECTION=endpointslices: un Service est bancal s'il n'a aucun endpoint prêt
+# dans ses EndpointSlices (API discovery.k8s.io, version ENDPOINTSLICE_VERSION)
+lame_detection = os.environ.get('LAME_DETECTION', 'pods')
+if lame_detection not in ('pods', 'endpointslices'):
+    logging.error(f"Bad value for environment variable LAME_DETECTION: {lame_detection}")
+    lame_detection = 'pods'
+endpointslice_version = os.environ.get('ENDPOINTSLICE_VERSION', 'v1')
+SERVICE_NAME_LABEL = 'kubernetes.io/service-name'
+
+# Un CriticalService peut demander un pool de "warmPool" POD de réserve, créés à partir
+# du POD Template avec le seul label POOL_LABEL: en cas de panne, l'un d'eux reçoit les
+# labels du Service au lieu de créer un POD. L'annotation SERVICE_ANNOTATION désigne le
+# Service dont un POD est le POD par défaut
+POOL_LABEL = 'service-watcher/pool'
+SERVICE_ANNOTATION = 'service-watcher/service'
+POOL_KEY_PREFIX = 'pool:'
+
+# Tous les POD créés par le contrôleur portent le label OWNED_LABEL: ils sont suivis par
+# un Watch dédié (filtré sur ce label) et exclus du Watch des autres POD. Les POD de ce
+# registre qui ne sont ni dans un pool ni le POD par défaut d'un Service sont détruits
+OWNED_LABEL = 'service-watcher/owned'
+GC_KEY = 'gc:'
+# Les POD par défaut des versions précédentes portent l'annotation "service-watcher: owned"
+# mais pas le label OWNED_LABEL: ils ne sont pas comptés parmi les POD des Services et sont
+# adoptés (label et SERVICE_ANNOTATION ajoutés) pour rejoindre le registre ci-dessus
+ADOPT_KEY_PREFIX = 'adopt:'
+
+# Election d'un leader via un Lease (coordination.k8s.io): plusieurs réplicas peuvent
+# tourner, tous tiennent leurs caches à jour mais seul le leader crée ou détruit des POD
+leader_election = os.environ.get('LEADER_ELECTION', 'false').lower() in ('true', 'yes', '1')
+lease_name = os.environ.get('LEASE_NAME', 'service-watcher')
+lease_namespace = os.environ.get('LEASE_NAMESPACE', pod_template_ns)
+lease_duration = int(os.environ['LEASE_DURATION']) if 'LEASE_DURATION' in os.environ else 15
+lease_renew_deadline = float(os.environ['LEASE_RENEW_DEADLINE']) if 'LEASE_RENEW_DEADLINE' in os.environ else 10.0
+lease_retry_period = float(os.environ['LEASE_RETRY_PERIOD']) if 'LEASE_RETRY_PERIOD' in os.environ else 2.0
+# Chaque requête sur les Lease est abandonnée après LEASE_REQUEST_TIMEOUT secondes, pour
+# qu'une connexion morte ne retienne pas un leader au-delà de LEASE_RENEW_DEADLINE.
+# urllib3 tente une lecture (GET) jusqu'à 4 fois: la valeur par défaut en tient compte
+lease_request_timeout = float(os.environ['LEASE_REQUEST_TIMEOUT']) if 'LEASE_REQUEST_TIMEOUT' in os.environ \
+    else lease_renew_deadline / 4
+leader_identity = os.environ.get('LEADER_IDENTITY', f"{socket.gethostname()}-{os.getpid()}")
+
+# Mode "sharding" (SHARDING=true): les namespaces (ceux de NAMESPACES, ou tous ceux du
+# cluster) sont répartis entre les réplicas par hachage cohérent (SHARD_VNODES points
+# par réplica sur l'anneau). Chaque réplica renouvelle son Lease de membre
+# "<LEASE_NAME>-<LEADER_IDENTITY>" dans LEASE_NAMESPACE; un membre dont le Lease n'a pas
+# changé depuis LEASE_DURATION secondes est considéré parti et ses namespaces sont
+# réattribués. Chaque réplica ne surveille et ne réconcilie que ses namespaces
+sharding = os.environ.get('SHARDING', 'false').lower() in ('true', 'yes', '1')
+shard_vnodes = int(os.environ['SHARD_VNODES']) if 'SHARD_VNODES' in os.environ else 64
+SHARD_LABEL = 'service-watcher/shard'
+
+# Snapshot de l'état (caches, index, Services bancals, resourceVersions des Watch)
+# écrit toutes les SNAPSHOT_INTERVAL secondes dans SNAPSHOT_FILE: au redémarrage, les
+# Watch reprennent à partir de ces resourceVersions au lieu de tout relister
+snapshot_file = os.environ.get('SNAPSHOT_FILE', '')
+snapshot_interval = float(os.environ['SNAPSHOT_INTERVAL']) if 'SNAPSHOT_INTERVAL' in os.environ else 30.0
+SNAPSHOT_FORMAT = 4
+
+# Tous les LIST sont lus par pages de LIST_PAGE_SIZE objets ("limit"/"continue")
+# et traités page par page: la mémoire consommée dépend de la taille des pages.
+# Resynchronisation (RESYNC_PERIOD secondes, 0 pour la désactiver): les caches sont
+# comparés à un nouveau LIST. Seuls les objets dont l'écart est constaté par deux
+# resynchronisations successives sont corrigés
+resync_period = float(os.environ['RESYNC_PERIOD']) if 'RESYNC_PERIOD' in os.environ else 0.0
+list_page_size = int(os.environ['LIST_PAGE_SIZE']) if 'LIST_PAGE_SIZE' in os.environ else 500
+
+# Traces (TRACE=true): chaque étape (traitement d'un événement, attente dans la file de
+# travail, décision, lecture du POD Template, création ou destruction d'un POD, appels
+# d'écriture) est écrite en JSON, une ligne par étape, sur la sortie d'erreur ou dans
+# TRACE_FILE. Une réconciliation porte l'identifiant ("trace_id") de l'événement qui a
+# placé sa clé dans la file. PROFILE_SAMPLE (entre 0 et 1) est la part des
+# réconciliations exécutées sous cProfile; les statistiques cumulées sont écrites
+# dans PROFILE_FILE toutes les PROFILE_INTERVAL secondes
+trace_enabled = os.environ.get('TRACE', 'false').lower() in ('true', 'yes', '1')
+trace_file = os.environ.get('TRACE_FILE', '')
+profile_sample = float(os.environ['PROFILE_SAMPLE']) if 'PROFILE_SAMPLE' in os.environ else 0.0
+profile_file = os.environ.get('PROFILE_FILE', os.path.join(tempfile.gettempdir(), 'service-watcher.prof'))
+profile_interval = float(os.environ['PROFILE_INTERVAL']) if 'PROFILE_INTERVAL' in os.environ else 60.0
+
+trace_logger = logging.getLogger('service-watcher.trace')
+if trace_enabled:
+    trace_logger.addHandler(logging.FileHandler(trace_file) if trace_file else logging.StreamHandler())
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+# Taille des caches (nombre d'objets et octets occupés) relevée toutes les
+# CACHE_REPORT_INTERVAL secondes (0 pour ne pas la relever)
+cache_report_interval = float(os.environ['CACHE_REPORT_INTERVAL']) if 'CACHE_REPORT_INTERVAL' in os.environ else 60.0
+
+# Métriques Prometheus exposées sur /metrics (METRICS_PORT=0 pour les désactiver).
+# En mode "process", chaque processus écrit ses métriques dans un répertoire commun
+# (mode multiprocess de prometheus_client) qui doit être connu avant l'import
+metrics_port = int(os.environ['METRICS_PORT']) if 'METRICS_PORT' in os.environ else 8000
+if metrics_port and runtime == 'process' and 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='service-watcher-metrics-')
+
+import prometheus_client
+from prometheus_client import Counter, Gauge, Histogram, multiprocess
+
+events_received = Counter('service_watcher_events_received_total', 'Watch events received', ['kind', 'type'])
+queue_depth = Gauge('service_watcher_queue_depth', 'Items waiting in the event and work queues', ['queue'],
+                    multiprocess_mode='livesum')
+reconcile_duration = Histogram('service_watcher_reconcile_duration_seconds', 'Duration of one Service reconcile')
+api_requests = Counter('service_watcher_api_requests_total', 'API-server requests', ['verb', 'code'])
+api_duration = Histogram('service_watcher_api_request_duration_seconds', 'API-server request latency', ['verb'])
+api_retries = Counter('service_watcher_api_retries_total', 'API-server write requests retried', ['verb'])
+write_throttle = Histogram('service_watcher_write_throttle_seconds', 'Time spent waiting for the write rate limiter')
+lame_services = Gauge('service_watcher_lame_services', 'Services without any selected POD',
+                      multiprocess_mode='livesum')
+critical_services = Gauge('service_watcher_critical_services', 'CriticalServices defined',
+                          multiprocess_mode='livesum')
+default_pods_created = Counter('service_watcher_default_pods_created_total', 'Default PODs created')
+default_pods_deleted = Counter('service_watcher_default_pods_deleted_total', 'Default PODs deleted')
+default_pods_promoted = Counter('service_watcher_default_pods_promoted_total', 'Warm pool PODs turned into default PODs')
+is_leader = Gauge('service_watcher_leader', '1 if this replica holds the leader Lease', multiprocess_mode='livesum')
+cache_objects = Gauge('service_watcher_cache_objects', 'Objects held in a local cache', ['cache'],
+                      multiprocess_mode='livesum')
+cache_bytes = Gauge('service_watcher_cache_bytes', 'Approximate memory held by a local cache', ['cache'],
+                    multiprocess_mode='livesum')
+shard_size = Gauge('service_watcher_shard_namespaces', 'Namespaces assigned to this replica',
+                   multiprocess_mode='livesum')
+resync_drifts = Counter('service_watcher_resync_drifts_total', 'Cached objects corrected by a resync', ['kind'])
+
+# Clients de l'API, créés par _init_clients() dans chaque processus: "watch_v1" et
+# "custom_api" pour les Watch, "v1" et "coordination_api" pour les autres requêtes
+v1 = None
+watch_v1 = None
+custom_api = None
+coordination_api = None
+
+# Positionné tant que ce réplica est le leader (toujours, sans élection)
+leading = threading.Event()
+
+# Mode "sharding": namespaces attribués à ce réplica (None sans sharding) et
+# arrêt des Watchers de chacun de ces namespaces {namespace: threading.Event}
+shard_namespaces = set() if sharding else None
+shard_watchers = {}
+shard_queue = None
+
+# Etat restauré par main() depuis le snapshot, avant le lancement des Watchers
+resume_versions = {}  # {(type d'objet, namespace): resourceVersion de reprise du Watch}
+restored = None       # (lame_svc, critical_svc) du snapshot
+
+
+class ObjectRecord:
+    '''Version compacte d'un Service, d'un CriticalService, d'un POD Template
+       ou d'une EndpointSlice (les POD sont des PodRecord), limitée aux champs
+       utilisés par handle_events. C'est elle, et non le modèle complet de
+       l'API, qui transite par la Queue entre processus.'''
+    __slots__ = ('namespace', 'name', 'resource_version', 'labels',
+                 'selector', 'svc_type', 'spec', 'ready')
+
+    def __init__(self, namespace, name, resource_version, labels=None,
+                 selector=None, svc_type=None, spec=None, ready=()):
+        self.namespace = namespace
+        self.name = name
+        self.resource_version = resource_version
+        self.labels = labels
+        self.selector = selector      # Service: "selector"
+        self.svc_type = svc_type      # Service: type (ClusterIP, ExternalName...)
+        self.spec = spec              # CriticalService: spec complète, PodTemplate: spec du POD
+        self.ready = ready            # EndpointSlice: POD (ou adresses) des endpoints prêts
+
+    def __reduce__(self):
+        # Sérialisation sous forme de tuple, sans le nom des attributs
+        return (ObjectRecord, tuple(getattr(self, slot) for slot in self.__slots__))
+
+
+class PodRecord:
+    '''Version compacte d'un POD: les seuls champs utilisés par handle_events,
+       lus directement dans le JSON de l'API-Server.'''
+    __slots__ = ('namespace', 'name', 'resource_version', 'labels', 'phase', 'ready', 'owned', 'service')
+
+    def __init__(self, namespace, name, resource_version, labels=None, phase=None, ready=False,
+                 owned=False, service=None):
+        self.namespace = namespace
+        self.name = name
+        self.resource_version = resource_version
+        self.labels = labels
+        self.phase = phase            # phase (Pending, Running...)
+        self.ready = ready            # condition "Ready" vraie
+        self.owned = owned            # annotation "service-watcher: owned" (POD à adopter, voir ADOPT_KEY_PREFIX)
+        self.service = service        # Service dont c'est le POD par défaut (SERVICE_ANNOTATION)
+
+    def __reduce__(self):
+        return (PodRecord, tuple(getattr(self, slot) for slot in self.__slots__))
+
+
+class WatchEvent:
+    '''Evénement publié par un Watcher: type (ADDED, MODIFIED, DELETED ou les
+       marqueurs RELIST/SYNCED, LEADING pour l'élection), type d'objet,
+       namespace surveillé (None pour tout le cluster) et ObjectRecord concerné.
+       "resource_version" est la position du Watch une fois l'événement traité:
+       celle de l'objet pour un événement du Watch, celle du LIST pour SYNCED,
+       None pour les objets d'un LIST en cours.'''
+    __slots__ = ('type', 'kind', 'scope', 'obj', 'resource_version')
+
+    def __init__(self, type, kind, scope=None, obj=None, resource_version=None):
+        self.type = type
+        self.kind = kind
+        self.scope = scope
+        self.obj = obj
+        self.resource_version = resource_version
+
+    def __reduce__(self):
+        return (WatchEvent, (self.type, self.kind, self.scope, self.obj, self.resource_version))
+
+
+def _record(kind, obj):
+    '''Construit l'ObjectRecord d'un objet retourné par l'API.'''
+    if kind == 'CriticalService':
+        metadata = obj['metadata']
+        return ObjectRecord(None, metadata['name'], metadata.get('resourceVersion'), spec=obj.get('spec'))
+    if kind == 'EndpointSlice':
+        # Un endpoint dont la condition "ready" est absente est considéré comme prêt.
+        # Les endpoints sont identifiés par leur POD pour écarter le POD par défaut
+        metadata = obj['metadata']
+        ready = tuple((endpoint.get('targetRef') or {}).get('name') or ','.join(endpoint.get('addresses') or ())
+                      for endpoint in obj.get('endpoints') or ()
+                      if (endpoint.get('conditions') or {}).get('ready') is not False)
+        return ObjectRecord(metadata['namespace'], metadata['name'], metadata.get('resourceVersion'),
+                            metadata.get('labels') or {}, ready=ready)
+
+    if kind in ('Pod', 'OwnedPod'):
+        metadata = obj['metadata']
+        annotations = metadata.get('annotations') or {}
+        status = obj.get('status') or {}
+        ready = any(condition.get('type') == 'Ready' and condition.get('status') == 'True'
+                    for condition in status.get('conditions') or ())
+        return PodRecord(metadata.get('namespace'), metadata['name'], metadata.get('resourceVersion'),
+                         metadata.get('labels') or {}, status.get('phase'), ready,
+                         annotations.get('service-watcher') == 'owned', annotations.get(SERVICE_ANNOTATION))
+
+    metadata = obj['metadata']
+    if kind == 'PodTemplate':
+        return ObjectRecord(metadata.get('namespace'), metadata['name'], metadata.get('resourceVersion'),
+                            spec=obj['template']['spec'])
+    spec = obj.get('spec') or {}
+    return ObjectRecord(metadata.get('namespace'), metadata['name'], metadata.get('resourceVersion'),
+                        metadata.get('labels'), selector=spec.get('selector'), svc_type=spec.get('type'))
+
+
+class Store:
+    '''Cache local (façon "informer") des objets d'un type donné.
+       Les objets sont rangés par namespace puis par nom. Le cache est
+       amorcé une seule fois par un LIST puis tenu à jour par les
+       événements des Watchers: les fonctions de contrôle le consultent
+       au lieu d'interroger l'API-Server.'''
+
+    def __init__(self):
+        self._objects = {}  # {namespace: {name: objet}}
+
+    def upsert(self, obj):
+        '''Ajoute ou remplace l'objet et retourne l'ancienne version (ou None).'''
+        objects = self._objects.setdefault(obj.namespace, {})
+        old = objects.get(obj.name)
+        objects[obj.name] = obj
+        return old
+
+    def delete(self, namespace, name):
+        '''Supprime l'objet et retourne la version supprimée (ou None).'''
+        objects = self._objects.get(namespace, {})
+        old = objects.pop(name, None)
+        if not objects:
+            self._objects.pop(namespace, None)
+        return old
+
+    def get(self, namespace, name):
+        return self._objects.get(namespace, {}).get(name)
+
+    def list(self, namespace=None):
+        '''Liste les objets d'un namespace ou bien de tous les namespaces.'''
+        if namespace is not None:
+            return list(self._objects.get(namespace, {}).values())
+        return [obj for objects in self._objects.values() for obj in objects.values()]
+
+    def __len__(self):
+        return sum(len(objects) for objects in self._objects.values())
+
+    def copy(self):
+        '''Copie du cache qui partage ses objets (ils ne sont jamais modifiés
+           une fois rangés dans le cache).'''
+        copy = self.__class__.__new__(self.__class__)
+        copy._objects = {namespace: dict(objects) for namespace, objects in self._objects.items()}
+        return copy
+
+    def footprint(self):
+        '''Taille approximative du cache en octets: ses dictionnaires, les
+           objets et leurs attributs (un seul niveau pour les dictionnaires
+           et les tuples). Un objet partagé n'est compté qu'une fois.'''
+        seen = set()
+
+        def sizeof(value):
+            if id(value) in seen:
+                return 0
+            seen.add(id(value))
+            size = sys.getsizeof(value)
+            if isinstance(value, dict):
+                size += sum(sizeof(k) + sizeof(v) for k, v in value.items())
+            elif isinstance(value, tuple):
+                size += sum(sizeof(v) for v in value)
+            return size
+
+        size = sys.getsizeof(self._objects)
+        for namespace, objects in self._objects.items():
+            size += sizeof(namespace) + sys.getsizeof(objects)
+            for name, obj in objects.items():
+                size += sizeof(name) + sys.getsizeof(obj)
+                size += sum(sizeof(getattr(obj, slot)) for slot in obj.__slots__)
+        return size
+
+
+class Labels(dict):
+    '''Labels d'un POD, partagés entre tous les POD qui ont les mêmes (ceux
+       d'un même ReplicaSet): ils ne doivent pas être modifiés.'''
+    __slots__ = ('__weakref__',)
+
+
+class PodStore(Store):
+    '''Cache des POD: les chaînes répétées d'un POD à l'autre (namespace,
+       phase, clés et valeurs des labels) sont "internées" et un même jeu de
+       labels n'est conservé qu'une fois, quel que soit le nombre de POD.'''
+
+    def __init__(self):
+        super().__init__()
+        self._label_sets = weakref.WeakValueDictionary()  # {frozenset des labels: Labels}
+
+    def __getstate__(self):
+        return self._objects
+
+    def __setstate__(self, objects):
+        self.__init__()
+        for pods in objects.values():
+            for pod in pods.values():
+                self.upsert(pod)
+
+    def _labels(self, labels):
+        key = frozenset(labels.items())
+        shared = self._label_sets.get(key)
+        if shared is None:
+            shared = Labels((sys.intern(k), sys.intern(v)) for k, v in labels.items())
+            self._label_sets[key] = shared
+        return shared
+
+    def upsert(self, pod):
+        pod.namespace = sys.intern(pod.namespace)
+        if pod.phase is not None:
+            pod.phase = sys.intern(pod.phase)
+        pod.labels = self._labels(pod.labels or {})
+        return super().upsert(pod)
+
+
+class SelectorIndex:
+    '''Index inverse des "selector" des Services: chaque triplet
+       (namespace, clé, valeur) donne les Services dont le "selector"
+       contient ce label. Les Services sélectionnés par un POD s'obtiennent
+       donc en parcourant les seuls labels du POD. L'index tient aussi
+       à jour le nombre de POD sélectionnés par chaque Service.'''
+
+    def __init__(self):
+        self._index = {}      # {(namespace, clé, valeur): {noms des Services}}
+        self._selectors = {}  # {(namespace, nom du Service): selector}
+        self._counts = {}     # {(namespace, nom du Service): nombre de POD sélectionnés}
+
+    def add_service(self, svc, pods):
+        '''(Ré)indexe le Service "svc" et recompte les POD qu'il sélectionne
+           parmi "pods" (les POD de son namespace).'''
+        self.remove_service(svc.namespace, svc.name)
+        selector = svc.selector
+        if not selector or svc.svc_type == 'ExternalName':
+            return
+
+        key = (svc.namespace, svc.name)
+        self._selectors[key] = dict(selector)
+        for k, v in selector.items():
+            self._index.setdefault((svc.namespace, k, v), set()).add(svc.name)
+        self._counts[key] = sum(1 for pod in pods if not pod.owned and _labels_match(pod.labels, selector))
+
+    def remove_service(self, namespace, name):
+        selector = self._selectors.pop((namespace, name), None)
+        self._counts.pop((namespace, name), None)
+        if selector is None:
+            return
+        for k, v in selector.items():
+            names = self._index.get((namespace, k, v))
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._index[(namespace, k, v)]
+
+    def match(self, namespace, labels):
+        '''Retourne les noms des Services du namespace dont le "selector"
+           est satisfait par les labels donnés.'''
+        hits = {}
+        for k, v in (labels or {}).items():
+            for name in self._index.get((namespace, k, v), ()):
+                hits[name] = hits.get(name, 0) + 1
+        return {name for name, n in hits.items() if n == len(self._selectors[(namespace, name)])}
+
+    def update_pod(self, namespace, old_labels, new_labels):
+        '''Met à jour les compteurs suite à l'ajout (old_labels à None), la
+           modification ou la destruction (new_labels à None) d'un POD.
+           Retourne les noms des Services concernés par le changement.'''
+        old = self.match(namespace, old_labels) if old_labels is not None else set()
+        new = self.match(namespace, new_labels) if new_labels is not None else set()
+        for name in old - new:
+            self._counts[(namespace, name)] -= 1
+        for name in new - old:
+            self._counts[(namespace, name)] += 1
+        return old | new
+
+    def count(self, namespace, name):
+        '''Nombre de POD sélectionnés par le Service (0 s'il n'est pas indexé).'''
+        return self._counts.get((namespace, name), 0)
+
+
+class EndpointIndex:
+    '''Nombre d'endpoints prêts de chaque Service, cumulé sur les
+       EndpointSlices qui portent le label "kubernetes.io/service-name".'''
+
+    def __init__(self):
+        self._ready = {}  # {(namespace, nom du Service): {nom de l'EndpointSlice: POD des endpoints prêts}}
+
+    def update(self, old, new):
+        '''Prend en compte l'ajout (old à None), la modification ou la
+           destruction (new à None) d'une EndpointSlice. Retourne les
+           noms des Services concernés.'''
+        names = set()
+        if old is not None:
+            name = (old.labels or {}).get(SERVICE_NAME_LABEL)
+            slices = self._ready.get((old.namespace, name), {})
+            slices.pop(old.name, None)
+            if not slices:
+                self._ready.pop((old.namespace, name), None)
+            names.add(name)
+        if new is not None:
+            name = (new.labels or {}).get(SERVICE_NAME_LABEL)
+            self._ready.setdefault((new.namespace, name), {})[new.name] = new.ready
+            names.add(name)
+        names.discard(None)
+        return names
+
+    def count(self, namespace, name, exclude=None):
+        '''Nombre d'endpoints prêts du Service (0 s'il n'a pas d'EndpointSlice),
+           sans ceux du POD "exclude".'''
+        return sum(len(ready) - ready.count(exclude) for ready in self._ready.get((namespace, name), {}).values())
+
+
+class LabelIndex:
+    '''Index des labels des Services du cache: chaque triplet
+       (namespace, clé, valeur) donne les Services qui portent ce label.'''
+
+    def __init__(self):
+        self._index = {}  # {(namespace, clé, valeur): {noms des Services}}
+
+    def update(self, old, new):
+        '''Remplace les labels de l'ancienne version (old, None pour un ajout)
+           par ceux de la nouvelle (new, None pour une destruction).'''
+        if old is not None:
+            for k, v in (old.labels or {}).items():
+                names = self._index.get((old.namespace, k, v))
+                if names is not None:
+                    names.discard(old.name)
+                    if not names:
+                        del self._index[(old.namespace, k, v)]
+        if new is not None:
+            for k, v in (new.labels or {}).items():
+                self._index.setdefault((new.namespace, k, v), set()).add(new.name)
+
+    def find(self, namespace, labels):
+        '''Retourne les noms des Services du namespace qui portent tous les labels donnés.'''
+        candidates = sorted((self._index.get((namespace, k, v), set()) for k, v in labels.items()), key=len)
+        return set.intersection(*candidates) if candidates else set()
+
+
+class CriticalServiceIndex:
+    '''CriticalServices compilés: leurs matchLabels sont rangés par
+       (namespace, clé, valeur). Un Service est critique s'il porte le nom
+       d'un CriticalService de son namespace ou si ses labels satisfont tous
+       les matchLabels d'un CriticalService: seuls les CriticalServices qui
+       exigent l'un des labels du Service sont examinés.'''
+
+    def __init__(self):
+        self._specs = {}      # {nom: spec}
+        self._required = {}   # {nom: {clé: valeur}}, None si les matchLabels se contredisent
+        self._index = {}      # {(namespace, clé, valeur): {noms des CriticalServices}}
+        self._match_all = {}  # {namespace: {noms des CriticalServices sans matchLabels}}
+
+    def get(self, name):
+        return self._specs.get(name)
+
+    def items(self):
+        return self._specs.items()
+
+    def __len__(self):
+        return len(self._specs)
+
+    def set(self, name, spec):
+        '''Ajoute ou remplace le CriticalService "name".'''
+        self.pop(name)
+        self._specs[name] = spec
+        required = self._required[name] = _compile_match_labels(spec)
+        if required is None:
+            return
+        if not required:
+            self._match_all.setdefault(spec['namespace'], set()).add(name)
+        for k, v in required.items():
+            self._index.setdefault((spec['namespace'], k, v), set()).add(name)
+
+    def pop(self, name):
+        '''Supprime le CriticalService "name" et retourne sa spec (ou None).'''
+        spec = self._specs.pop(name, None)
+        if spec is None:
+            return None
+        required = self._required.pop(name)
+        if required == {}:
+            names = self._match_all[spec['namespace']]
+            names.discard(name)
+            if not names:
+                del self._match_all[spec['namespace']]
+        for k, v in (required or {}).items():
+            names = self._index[(spec['namespace'], k, v)]
+            names.discard(name)
+            if not names:
+                del self._index[(spec['namespace'], k, v)]
+        return spec
+
+    def matching(self, svc):
+        '''Retourne les noms des CriticalServices qui rendent le Service critique.'''
+        names = set(self._match_all.get(svc.namespace, ()))
+        spec = self._specs.get(svc.name)
+        if spec is not None and spec['namespace'] == svc.namespace:
+            names.add(svc.name)
+        hits = {}
+        for k, v in (svc.labels or {}).items():
+            for name in self._index.get((svc.namespace, k, v), ()):
+                hits[name] = hits.get(name, 0) + 1
+        names.update(name for name, n in hits.items() if n == len(self._required[name]))
+        return names
+
+    def is_critical(self, svc):
+        return bool(self.matching(svc))
+
+
+class WarmPools:
+    '''POD de réserve des CriticalServices, rangés par pool (valeur du label
+       POOL_LABEL, c'est-à-dire le nom du CriticalService). Un POD choisi pour
+       remplacer un Service est réservé jusqu'à ce qu'il quitte le pool.'''
+
+    def __init__(self):
+        self._pods = {}        # {pool: {nom du POD: ObjectRecord}}
+        self._claimed = set()  # (namespace, nom) des POD en cours de promotion
+
+    def __getstate__(self):
+        # Les réservations ne survivent pas à un redémarrage
+        return self._pods
+
+    def __setstate__(self, pods):
+        self._pods = pods
+        self._claimed = set()
+
+    def update(self, old, new):
+        '''Prend en compte l'ajout (old à None), la modification ou la
+           destruction (new à None) d'un POD. Retourne les pools concernés.'''
+        pools = set()
+        for pod in (old, new):
+            pool = (pod.labels or {}).get(POOL_LABEL) if pod is not None else None
+            if pool is None:
+                continue
+            pods = self._pods.setdefault(pool, {})
+            if pod is old:
+                pods.pop(old.name, None)
+            else:
+                pods[new.name] = new
+            if not pods:
+                del self._pods[pool]
+            pools.add(pool)
+        if old is not None and (new is None or POOL_LABEL not in (new.labels or {})):
+            self._claimed.discard((old.namespace, old.name))
+        return pools
+
+    def names(self):
+        return list(self._pods)
+
+    def idle(self, pool):
+        '''POD du pool qui ne sont pas réservés.'''
+        return [pod for pod in self._pods.get(pool, {}).values() if (pod.namespace, pod.name) not in self._claimed]
+
+    def claim(self, pools, namespace):
+        '''Réserve un POD libre (prêt, ou Running, de préférence) de l'un des pools et
+           retourne son nom, ou None si les pools sont vides.'''
+        candidates = [pod for pool in pools for pod in self.idle(pool) if pod.namespace == namespace]
+        if not candidates:
+            return None
+        pod = min(candidates, key=lambda pod: (not pod.ready, pod.phase != 'Running', pod.name))
+        self._claimed.add((pod.namespace, pod.name))
+        return pod.name
+
+    def release(self, namespace, name):
+        self._claimed.discard((namespace, name))
+
+
+def _compile_match_labels(spec):
+    '''Retourne les matchLabels du CriticalService sous la forme {clé: valeur},
+       ou None si une même clé est exigée avec deux valeurs différentes.'''
+    required = {}
+    for matchLabel in spec.get('matchLabels') or ():
+        if required.setdefault(matchLabel['key'], matchLabel['value']) != matchLabel['value']:
+            return None
+    return required
+
+
+def _critical_spec_error(spec):
+    '''Retourne la raison pour laquelle la spec d'un CriticalService est
+       inutilisable (le CRD n'impose pas tous ses champs), ou None.'''
+    if not isinstance(spec, dict) or not isinstance(spec.get('namespace'), str):
+        return "no spec.namespace"
+    for matchLabel in spec.get('matchLabels') or ():
+        if not isinstance(matchLabel, dict) or not isinstance(matchLabel.get('key'), str) \
+                or not isinstance(matchLabel.get('value'), str):
+            return "matchLabels entry without key or value"
+    return None
+
 
+def _labels_match(labels, selector):
+    labels = labels or {}
+    return all(labels.get(k) == v for k, v in selector.items())
 
-def watch_services(q):
-    w = watch.Watch()
-    for event in w.stream(v1.list_service_for_all_namespaces):
-        metadata = event['object'].metadata
-        spec = event['object'].spec
-        logging.info(f"Event {event['type']}, Service Name: {metadata.name}, Service Type: {spec.type}, Namespace: {metadata.namespace}")
 
-        if not len(ns) or metadata.namespace in ns:
-            q.put(event)
+# Caches alimentés par les Watchers (utilisés uniquement dans le processus handle_events)
+svc_cache = Store()
+pod_cache = PodStore()
+svc_index = SelectorIndex()
+svc_labels = LabelIndex()
+template_cache = Store()
+slice_cache = Store()
+owned_cache = PodStore()  # POD portant le label OWNED_LABEL
+endpoint_index = EndpointIndex()
+warm_pools = WarmPools()
+default_pods = {}  # {(namespace, Service): nom de son POD par défaut (SERVICE_ANNOTATION)}
+caches = {'Service': svc_cache, 'Pod': pod_cache, 'PodTemplate': template_cache, 'EndpointSlice': slice_cache,
+          'OwnedPod': owned_cache}
 
+# Protège les caches, les index et l'état partagés entre la boucle des événements et les workers
+state_lock = threading.RLock()
 
-def watch_pods(q):
-    w = watch.Watch()
-    for event in w.stream(v1.list_pod_for_all_namespaces):
-        metadata = event['object'].metadata
-        spec = event['object'].spec
-        logging.info(f"Event {event['type']}, POD Name: {metadata.name}, Namespace: {metadata.namespace}")
 
-        if not len(ns) or metadata.namespace in ns:
-            q.put(event)
+_trace_ids = itertools.count(1)
+# "trace_id" de l'événement ou de la réconciliation en cours: propre à chaque thread
+# et, en mode asyncio, à chaque tâche de la boucle
+_trace_id = contextvars.ContextVar('trace_id', default=None)
+_trace_keys = {}                    # {clé en attente: (trace_id, instant de son ajout)}
+_profile_lock = threading.Lock()
+_profiling = threading.Lock()  # tenu pendant une réconciliation profilée
+_profile_stats = None
+_profile_dumped = time.monotonic()
+
+
+def _new_trace_id():
+    return f"{os.getpid():x}-{next(_trace_ids):x}"
+
+
+@contextmanager
+def span(name, **fields):
+    '''Mesure une étape et l'écrit en JSON si les traces sont activées. Les
+       champs ajoutés au dictionnaire produit sont écrits avec elle.'''
+    if not trace_enabled:
+        yield fields
+        return
+    trace_id = _trace_id.get()
+    start = time.monotonic()
+    try:
+        yield fields
+    except Exception as e:
+        fields['error'] = repr(e)
+        raise
+    finally:
+        record = {'span': name, 'trace_id': trace_id,
+                  'duration_ms': round((time.monotonic() - start) * 1000, 3), 'pid': os.getpid()}
+        record.update(fields)
+        trace_logger.info(json.dumps(record, default=str))
+
+
+def _enqueue(work, key):
+    '''Place la clé dans la file de travail en notant, pour les traces,
+       l'événement qui l'y a mise.'''
+    if trace_enabled:
+        _trace_keys.setdefault(key, (_trace_id.get(), time.monotonic()))
+    work.add(key)
+
+
+def _dequeue_trace(key):
+    '''Retourne les champs de trace d'une clé sortie de la file de travail
+       et associe son trace_id au thread (ou à la tâche).'''
+    trace_id, added = _trace_keys.pop(key, (None, None))
+    _trace_id.set(trace_id)
+    queued = round((time.monotonic() - added) * 1000, 3) if added is not None else None
+    return {'key': key, 'queued_ms': queued}
+
+
+def _run_plan(trace_id, plan):
+    '''Exécute hors verrou l'appel décidé par _reconcile_plan.'''
+    _trace_id.set(trace_id)
+    with span('apply', action=plan[0].__name__.lstrip('_')):
+        plan[0](*plan[1:])
+
+
+def _profiled(sampled, func, *args):
+    '''Exécute func(*args), sous cProfile si la réconciliation fait partie de
+       l'échantillon; les statistiques sont cumulées puis écrites
+       périodiquement dans PROFILE_FILE. Une seule réconciliation est
+       profilée à la fois (un seul profileur par interpréteur depuis
+       Python 3.12): si une autre l'est déjà, celle-ci ne l'est pas.'''
+    global _profile_stats, _profile_dumped
+    if not sampled or not _profiling.acquire(blocking=False):
+        return func(*args)
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        _profiling.release()
+        with _profile_lock:
+            if _profile_stats is None:
+                _profile_stats = pstats.Stats(profile)
+            else:
+                _profile_stats.add(profile)
+            if time.monotonic() - _profile_dumped >= profile_interval:
+                _profile_stats.dump_stats(profile_file)
+                _profile_dumped = time.monotonic()
+                logging.warning(f"Reconcile profile written to {profile_file}")
+
+
+def _timeout(seconds):
+    '''Valeur de "_request_timeout": le client n'accepte qu'un entier ou un
+       couple (connexion, lecture), une durée décimale serait ignorée.'''
+    return (seconds, seconds)
+
+
+def _api_call(verb, func, *args, **kwargs):
+    '''Appelle l'API-Server en mesurant le nombre d'appels et leur latence par verbe.'''
+    start = time.monotonic()
+    code = '200'
+    try:
+        return func(*args, **kwargs)
+    except ApiException as e:
+        code = str(e.status)
+        raise
+    except Exception:
+        code = 'error'
+        raise
+    finally:
+        api_duration.labels(verb).observe(time.monotonic() - start)
+        api_requests.labels(verb, code).inc()
+
+
+class TokenBucket:
+    '''Limiteur de débit côté client: "rate" jetons par seconde, avec au plus
+       "burst" jetons d'avance. Un jeton est réservé dès la demande, ce qui
+       sert les appelants dans l'ordre d'arrivée. "rate" à 0 désactive la limite.'''
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Prend un jeton, en attendant si nécessaire; retourne l'attente.'''
+        if self._rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate) - 1
+            self._last = now
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+write_limiter = TokenBucket(write_qps, write_burst)
+
+
+def _already_exists(e):
+    return e.status == 409 and 'AlreadyExists' in str(e.body)
+
+
+def _is_transient(e):
+    '''409 Conflict (mais pas AlreadyExists), 429 et 5xx peuvent être réessayés.'''
+    return e.status == 429 or (e.status or 0) >= 500 or (e.status == 409 and not _already_exists(e))
+
+
+def _write_call(verb, func, *args, **kwargs):
+    '''Appel d'écriture à l'API-Server, soumis au limiteur de débit. Les erreurs
+       transitoires sont réessayées avec un délai exponentiel (ou celui de
+       l'en-tête Retry-After); la dernière erreur est levée. Chaque tentative
+       est limitée à "write_request_timeout" secondes: une connexion coupée
+       sans préavis est une erreur réseau comme une autre.'''
+    kwargs.setdefault('_request_timeout', _timeout(write_request_timeout))
+    pod = kwargs.get('name') or (kwargs.get('body') or {}).get('metadata', {}).get('name')
+    with span('write', verb=verb, pod=pod) as fields:
+        for attempt in range(write_retries + 1):
+            throttle = write_limiter.acquire()
+            write_throttle.observe(throttle)
+            fields['attempts'] = attempt + 1
+            fields['throttle_ms'] = fields.get('throttle_ms', 0) + round(throttle * 1000, 3)
+            try:
+                return _api_call(verb, func, *args, **kwargs)
+            except ApiException as e:
+                if attempt == write_retries or not _is_transient(e):
+                    raise
+                retry_after = (e.headers or {}).get('Retry-After')
+                error = e.status
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                if attempt == write_retries:
+                    raise
+                retry_after = None
+                error = e
+
+            delay = min(write_retry_delay * 2 ** attempt, write_retry_max_delay) * random.uniform(0.5, 1.0)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            logging.warning(f"{verb} failed ({error}), retry {attempt + 1}/{write_retries} in {delay:.1f}s")
+            api_retries.labels(verb).inc()
+            time.sleep(delay)
+
+
+def _watch_stream(func, **kwargs):
+    '''Flux d'un Watch lu directement sur la réponse HTTP, sans passer par
+       watch.Watch() ni par les modèles du client: chaque ligne du corps
+       (transmis par "chunks") est un événement JSON, publié sous la forme
+       d'un dict. La connexion est rendue au pool quand le flux est fermé.'''
+    resp = func(watch=True, _preload_content=False, **kwargs)
+    try:
+        pending = b''
+        for chunk in resp.read_chunked(decode_content=False):
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                if line:
+                    yield json_loads(line)
+    finally:
+        resp.close()
+        resp.release_conn()
+
+
+def _list_pages(list_func, **kwargs):
+    '''LIST paginé ("limit"/"continue"): chaque page est publiée dès sa
+       réception, décodée sous la forme d'un dict ("items" et "metadata").'''
+    token = None
+    while True:
+        if token:
+            kwargs['_continue'] = token
+        resp = _api_call('list', list_func, watch=False, limit=list_page_size, _preload_content=False, **kwargs)
+        page = json_loads(resp.data)
+        yield page
+        token = page['metadata'].get('continue')
+        if not token:
+            return
+
+
+def _list_and_watch(q, kind, list_func, keep=None, bookmarks=True, stop=None, **kwargs):
+    '''Amorce le cache du consommateur avec un LIST encadré par les marqueurs
+       "RELIST" et "SYNCED", puis surveille les modifications à partir du
+       resourceVersion retourné par le LIST. Le dernier resourceVersion reçu
+       (y compris via les événements BOOKMARK) est mémorisé: si le flux est
+       interrompu, la surveillance reprend à partir de ce point. Un nouveau
+       LIST n'est effectué que si l'API-Server répond 410 (Gone).
+       La fonction "keep" permet de filtrer les objets qui ne doivent pas
+       être publiés. Les objets sont publiés sous la forme de WatchEvent
+       qui portent le namespace surveillé (None pour tout le cluster).
+       Si le snapshot lu au démarrage donne un resourceVersion pour ce Watch,
+       le LIST initial est évité. Le Watch s'arrête quand "stop" est positionné.
+       Le LIST (paginé) et le flux sont lus en JSON brut: "keep" et _record()
+       reçoivent des dicts, jamais des modèles du client.'''
+    scope = kwargs.get('namespace')
+    resource_version = resume_versions.get((kind, scope))
+    failures = 0  # erreurs successives: le délai avant de rouvrir le Watch double à chacune
+    while stop is None or not stop.is_set():
+        try:
+            if resource_version is None:
+                # Le LIST est lu et publié page par page; toutes les pages sont lues au
+                # resourceVersion de la première. Si le jeton "continue" expire (410),
+                # le LIST est repris depuis le début
+                q.put(WatchEvent('RELIST', kind, scope))
+                count, list_version = 0, None
+                for page in _list_pages(list_func, **kwargs):
+                    list_version = list_version or page['metadata']['resourceVersion']
+                    for obj in page['items'] or ():
+                        if keep is None or keep(obj):
+                            q.put(WatchEvent('ADDED', kind, scope, _record(kind, obj)))
+                    count += len(page['items'] or ())
+                resource_version = list_version
+                failures = 0
+                logging.info(f"{kind}: {count} object(s) listed at resourceVersion {resource_version}")
+                q.put(WatchEvent('SYNCED', kind, scope, resource_version=resource_version))
+
+            watch_kwargs = dict(kwargs, resource_version=resource_version, timeout_seconds=watch_timeout)
+            if bookmarks:
+                watch_kwargs['allow_watch_bookmarks'] = True
+            with closing(_watch_stream(list_func, **watch_kwargs)) as stream:
+                for event in stream:
+                    events_received.labels(kind, event['type']).inc()
+                    if event['type'] == 'ERROR':
+                        status = event['object']
+                        if status.get('code') == 410:
+                            logging.warning(f"{kind}: resourceVersion {resource_version} expired, relisting")
+                            resource_version = None
+                        else:
+                            logging.error(f"{kind}: watch error: {status.get('message')}")
+                            failures = _watch_backoff(failures)
+                        break
+
+                    if stop is not None and stop.is_set():
+                        break
+                    failures = 0
+                    resource_version = event['object']['metadata'].get('resourceVersion')
+                    if event['type'] == 'BOOKMARK':
+                        continue
+                    if keep is None or keep(event['object']):
+                        q.put(WatchEvent(event['type'], kind, scope, _record(kind, event['object']), resource_version))
+        except ApiException as e:
+            if e.status == 410:
+                logging.warning(f"{kind}: resourceVersion {resource_version} expired, relisting")
+                resource_version = None
+            else:
+                logging.error(f"{kind}: watch error: {e}")
+                failures = _watch_backoff(failures)
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            logging.warning(f"{kind}: watch interrupted ({e}), resuming from resourceVersion {resource_version}")
+            failures = _watch_backoff(failures)
+
+
+def _watch_backoff(failures):
+    '''Attend avant de rouvrir un Watch après une erreur: WATCH_RETRY_DELAY,
+       doublé à chaque erreur successive jusqu'à WATCH_RETRY_MAX_DELAY.
+       Retourne le nouveau nombre d'erreurs successives.'''
+    time.sleep(min(watch_retry_delay * 2 ** min(failures, 16), watch_retry_max_delay))
+    return failures + 1
+
+
+def _in_namespaces(obj):
+    return not len(ns) or obj['metadata'].get('namespace') in ns
+
+
+def _watch_scopes():
+    '''Retourne les namespaces à surveiller individuellement, ou [None]
+       pour un unique Watch sur tout le cluster. En mode "sharding", ce
+       sont les namespaces attribués au réplica.'''
+    if sharding:
+        return sorted(shard_namespaces)
+    if namespaced_watches and len(ns):
+        return ns
+    return [None]
+
+
+def _selectors(label_selector, field_selector):
+    kwargs = {}
+    if label_selector:
+        kwargs['label_selector'] = label_selector
+    if field_selector:
+        kwargs['field_selector'] = field_selector
+    return kwargs
+
+
+def _keep_service(svc):
+    metadata = svc['metadata']
+    logging.info(f"Service Name: {metadata['name']}, Service Type: {svc['spec'].get('type')}, "
+                 f"Namespace: {metadata.get('namespace')}")
+    return _in_namespaces(svc)
+
+
+def _keep_pod(pod):
+    metadata = pod['metadata']
+    logging.info(f"POD Name: {metadata['name']}, Namespace: {metadata.get('namespace')}")
+    return _in_namespaces(pod)
+
+
+def _keep_critical_service(crisvc):
+    logging.info(f"CriticalService Name: {crisvc['metadata']['name']}")
+    return crisvc.get('kind', 'CriticalService') == 'CriticalService'
+
+
+def _keep_endpoint_slice(eps):
+    metadata = eps['metadata']
+    logging.info(f"EndpointSlice Name: {metadata['name']}, Namespace: {metadata.get('namespace')}")
+    return _in_namespaces(eps)
+
+
+def _list_source(kind, scope=None):
+    '''Fonction de LIST (et de Watch), filtre "keep" et paramètres des objets
+       "kind" du namespace "scope" (None pour tout le cluster), communs aux
+       Watchers et à la resynchronisation.'''
+    if kind == 'Service':
+        kwargs = _selectors(svc_label_selector, svc_field_selector)
+        funcs, keep = (watch_v1.list_service_for_all_namespaces, watch_v1.list_namespaced_service), _keep_service
+    elif kind == 'Pod':
+        # Les POD du contrôleur sont suivis par watch_owned_pods
+        kwargs = _selectors(','.join(filter(None, [pod_label_selector, '!' + OWNED_LABEL])), pod_field_selector)
+        funcs, keep = (watch_v1.list_pod_for_all_namespaces, watch_v1.list_namespaced_pod), _keep_pod
+    elif kind == 'OwnedPod':
+        kwargs = dict(label_selector=OWNED_LABEL)
+        funcs, keep = (watch_v1.list_pod_for_all_namespaces, watch_v1.list_namespaced_pod), _keep_pod
+    elif kind == 'EndpointSlice':
+        # Le client ne connaît pas l'API discovery.k8s.io: elle est lue comme des objets "custom".
+        # Seules les EndpointSlices rattachées à un Service sont surveillées
+        kwargs = dict(group='discovery.k8s.io', version=endpointslice_version, plural='endpointslices',
+                      label_selector=SERVICE_NAME_LABEL)
+        funcs, keep = (custom_api.list_cluster_custom_object, custom_api.list_namespaced_custom_object), \
+            _keep_endpoint_slice
+    elif kind == 'CriticalService':
+        kwargs = dict(group="mycrd.com", version="v1", plural="criticalservices")
+        funcs, keep = (custom_api.list_cluster_custom_object, None), _keep_critical_service
+    else: # PodTemplate
+        kwargs = dict(field_selector=f"metadata.name={pod_template}")
+        funcs, keep = (None, watch_v1.list_namespaced_pod_template), None
+
+    if scope is None:
+        return funcs[0], keep, kwargs
+    return funcs[1], keep, dict(kwargs, namespace=scope)
+
+
+def watch_services(q, namespace=None, stop=None):
+    list_func, keep, kwargs = _list_source('Service', namespace)
+    _list_and_watch(q, 'Service', list_func, keep, stop=stop, **kwargs)
+
+
+def watch_pods(q, namespace=None, stop=None):
+    list_func, keep, kwargs = _list_source('Pod', namespace)
+    _list_and_watch(q, 'Pod', list_func, keep, stop=stop, **kwargs)
+
+
+def watch_owned_pods(q, namespace=None, stop=None):
+    '''Surveille les seuls POD créés par le contrôleur (POD par défaut et
+       POD de réserve), repérés par le label OWNED_LABEL.'''
+    list_func, keep, kwargs = _list_source('OwnedPod', namespace)
+    _list_and_watch(q, 'OwnedPod', list_func, keep, stop=stop, **kwargs)
 
 
 def watch_critical_services(q):
-    w = watch.Watch()
-    for event in w.stream(custom_api.list_cluster_custom_object, group="mycrd.com", version="v1", plural="criticalservices"):
-        metadata = event['object']['metadata']
-        logging.info(f"Event {event['type']}, CriticalService Name: {metadata['name']}")
-        q.put(event)
+    # L'API des objets "custom" n'accepte pas le paramètre allow_watch_bookmarks
+    list_func, keep, kwargs = _list_source('CriticalService')
+    _list_and_watch(q, 'CriticalService', list_func, keep, bookmarks=False, **kwargs)
+
+
+def watch_endpoint_slices(q, namespace=None, stop=None):
+    list_func, keep, kwargs = _list_source('EndpointSlice', namespace)
+    _list_and_watch(q, 'EndpointSlice', list_func, keep, bookmarks=False, stop=stop, **kwargs)
+
+
+def _micro_time(dt=None):
+    '''Horodatage au format MicroTime attendu par les Lease.'''
+    dt = dt or datetime.now(timezone.utc)
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class LeaderElector:
+    '''Election d'un leader par un Lease, à la manière de client-go: le leader
+       renouvelle le Lease toutes les "lease_retry_period" secondes et se retire
+       s'il n'a pas pu le faire depuis "lease_renew_deadline" secondes. Les autres
+       réplicas prennent le Lease quand il n'a pas changé depuis "lease_duration"
+       secondes, mesurées avec leur propre horloge à partir du dernier
+       resourceVersion observé (les horloges des noeuds peuvent différer).
+       Les requêtes sont limitées à "lease_request_timeout" secondes et le délai
+       de renouvellement est vérifié par un thread dédié: un renouvellement
+       bloqué ne retarde pas le retrait du leader.'''
+
+    def __init__(self, identity):
+        self.identity = identity
+        self._observed_rv = None
+        self._observed_at = 0.0
+        self._last_renew = 0.0
+        self._lock = threading.Lock()
+
+    def _observe(self, lease):
+        if lease.metadata.resource_version != self._observed_rv:
+            self._observed_rv = lease.metadata.resource_version
+            self._observed_at = time.monotonic()
+
+    def try_acquire_or_renew(self):
+        '''Retourne True si le Lease est détenu par ce réplica, False s'il
+           l'est par un autre. Une ApiException 409 signale qu'un autre
+           réplica l'a modifié entre la lecture et l'écriture.'''
+        now = _micro_time()
+        try:
+            lease = _api_call('get', coordination_api.read_namespaced_lease, lease_name, lease_namespace,
+                              _request_timeout=_timeout(lease_request_timeout))
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            lease = client.V1Lease(
+                metadata=client.V1ObjectMeta(name=lease_name, namespace=lease_namespace),
+                spec=client.V1LeaseSpec(holder_identity=self.identity, lease_duration_seconds=lease_duration,
+                                        acquire_time=now, renew_time=now, lease_transitions=0))
+            self._observe(_api_call('create', coordination_api.create_namespaced_lease, lease_namespace, lease,
+                                    _request_timeout=_timeout(lease_request_timeout)))
+            return True
+
+        self._observe(lease)
+        spec = lease.spec
+        holder = spec.holder_identity
+        if holder and holder != self.identity and \
+                time.monotonic() < self._observed_at + (spec.lease_duration_seconds or lease_duration):
+            return False
+
+        if holder != self.identity:
+            spec.acquire_time = now
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+        elif isinstance(spec.acquire_time, datetime):
+            spec.acquire_time = _micro_time(spec.acquire_time)
+        spec.holder_identity = self.identity
+        spec.lease_duration_seconds = lease_duration
+        spec.renew_time = now
+        self._observe(_api_call('update', coordination_api.replace_namespaced_lease, lease_name, lease_namespace, lease,
+                                _request_timeout=_timeout(lease_request_timeout)))
+        return True
+
+    def _step_down(self, lost=False):
+        '''Retire ce réplica si un autre détient le Lease ("lost") ou si le
+           Lease n'a pas été renouvelé depuis "lease_renew_deadline" secondes.'''
+        with self._lock:
+            if leading.is_set() and (lost or time.monotonic() - self._last_renew > lease_renew_deadline):
+                logging.warning(f"{self.identity} is no longer the leader")
+                leading.clear()
+                is_leader.set(0)
+
+    def _deadline_loop(self):
+        while True:
+            time.sleep(min(lease_retry_period, 1.0))
+            self._step_down()
+
+    def run(self, q):
+        '''Boucle d'élection: publie un événement LEADING dans la queue de
+           handle_events à chaque prise du Lease.'''
+        threading.Thread(target=self._deadline_loop, name='leader-deadline', daemon=True).start()
+        while True:
+            try:
+                held = self.try_acquire_or_renew()
+            except ApiException as e:
+                if e.status != 409:
+                    logging.error(f"Lease {lease_namespace}/{lease_name}: {e}")
+                held = None
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                logging.warning(f"Lease {lease_namespace}/{lease_name}: {e}")
+                held = None
+            except Exception:
+                logging.exception(f"Lease {lease_namespace}/{lease_name}: election error")
+                held = None
+
+            if held:
+                with self._lock:
+                    self._last_renew = time.monotonic()
+                    if not leading.is_set():
+                        logging.warning(f"{self.identity} is now the leader")
+                        leading.set()
+                        is_leader.set(1)
+                        q.put(WatchEvent('LEADING', 'Lease'))
+            else:
+                self._step_down(lost=held is False)
+            time.sleep(lease_retry_period)
+
+
+def _start_leader_election(q):
+    '''Lance l'élection dans le processus de handle_events; sans élection,
+       le réplica est toujours leader. En mode "sharding", chaque réplica agit
+       sur ses namespaces et la répartition remplace l'élection.'''
+    if sharding:
+        _start_sharding(q)
+    if not leader_election or sharding:
+        leading.set()
+        is_leader.set(1)
+        return
+    threading.Thread(target=LeaderElector(leader_identity).run, args=(q,),
+                     name='leader-election', daemon=True).start()
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    '''Anneau de hachage cohérent: chaque membre y place "vnodes" points et
+       un namespace revient au membre du premier point qui le suit. Le départ
+       ou l'arrivée d'un membre ne déplace que les namespaces de ses points.'''
+
+    def __init__(self, members, vnodes):
+        self._ring = sorted((_hash(f"{member}#{i}"), member) for member in members for i in range(vnodes))
+        self._hashes = [h for h, member in self._ring]
+
+    def owner(self, key):
+        if not self._ring:
+            return None
+        return self._ring[bisect.bisect(self._hashes, _hash(key)) % len(self._ring)][1]
+
+
+class ShardManager:
+    '''Tient à jour le Lease de membre du réplica, la liste des membres (Lease
+       portant le label SHARD_LABEL) et les namespaces à répartir. Comme pour
+       l'élection, un Lease est vivant s'il a changé depuis moins de
+       "lease_duration" secondes, mesurées avec l'horloge du réplica. Un réplica
+       qui ne peut plus renouveler son Lease depuis "lease_renew_deadline"
+       secondes abandonne ses namespaces, même si une requête est bloquée.'''
+
+    def __init__(self, identity):
+        self.identity = identity
+        self.lease_name = f"{lease_name}-{identity}"
+        self._observed = {}          # {nom du Lease: (resourceVersion, instant de son dernier changement)}
+        self._namespaces = ns
+        self._namespaces_listed = 0.0
+        self._assigned = None
+        self._last_renew = time.monotonic()
+        self._lock = threading.Lock()
+
+    def renew(self):
+        now = _micro_time()
+        try:
+            lease = _api_call('get', coordination_api.read_namespaced_lease, self.lease_name, lease_namespace,
+                              _request_timeout=_timeout(lease_request_timeout))
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            lease = client.V1Lease(
+                metadata=client.V1ObjectMeta(name=self.lease_name, namespace=lease_namespace,
+                                             labels={SHARD_LABEL: lease_name}),
+                spec=client.V1LeaseSpec(holder_identity=self.identity, lease_duration_seconds=lease_duration,
+                                        acquire_time=now, renew_time=now))
+            _api_call('create', coordination_api.create_namespaced_lease, lease_namespace, lease,
+                      _request_timeout=_timeout(lease_request_timeout))
+            return
+        if isinstance(lease.spec.acquire_time, datetime):
+            lease.spec.acquire_time = _micro_time(lease.spec.acquire_time)
+        lease.spec.renew_time = now
+        _api_call('update', coordination_api.replace_namespaced_lease, self.lease_name, lease_namespace, lease,
+                  _request_timeout=_timeout(lease_request_timeout))
+
+    def members(self):
+        '''Identités des membres vivants; les Lease expirés sont détruits.'''
+        leases = [lease for page in _list_pages(coordination_api.list_namespaced_lease, namespace=lease_namespace,
+                                                label_selector=f"{SHARD_LABEL}={lease_name}",
+                                                _request_timeout=_timeout(lease_request_timeout))
+                  for lease in page['items'] or ()]
+        now = time.monotonic()
+        members = set()
+        observed = {}
+        for lease in leases:
+            name, version, spec = lease['metadata']['name'], lease['metadata']['resourceVersion'], lease['spec']
+            rv, changed = self._observed.get(name, (None, now))
+            if rv != version:
+                changed = now
+            observed[name] = (version, changed)
+            if name == self.lease_name or now < changed + (spec.get('leaseDurationSeconds') or lease_duration):
+                members.add(spec.get('holderIdentity'))
+            else:
+                logging.warning(f"Shard member {spec.get('holderIdentity')} left")
+                try:
+                    _api_call('delete', coordination_api.delete_namespaced_lease, name, lease_namespace,
+                              _request_timeout=_timeout(lease_request_timeout))
+                except ApiException as e:
+                    if e.status != 404:
+                        raise
+        self._observed = observed
+        return members
+
+    def namespaces(self):
+        '''Namespaces à répartir: ceux de NAMESPACES ou ceux du cluster,
+           relus toutes les "lease_duration" secondes.'''
+        if not len(ns) and time.monotonic() - self._namespaces_listed >= lease_duration:
+            self._namespaces = [namespace['metadata']['name']
+                                for page in _list_pages(v1.list_namespace, _request_timeout=_timeout(lease_request_timeout))
+                                for namespace in page['items'] or ()]
+            self._namespaces_listed = time.monotonic()
+        return self._namespaces
+
+    def _publish(self, q, owned, renewed=False):
+        '''Publie un événement SHARD si les namespaces attribués changent ("owned"
+           à None les laisse inchangés); sans renouvellement depuis
+           "lease_renew_deadline" secondes, le réplica n'en a plus aucun.'''
+        with self._lock:
+            if renewed:
+                self._last_renew = time.monotonic()
+            elif time.monotonic() - self._last_renew > lease_renew_deadline:
+                owned = frozenset()
+            if owned is not None and owned != self._assigned:
+                logging.warning(f"{self.identity} now owns {len(owned)} Namespace(s)")
+                q.put(WatchEvent('SHARD', 'Lease', obj=owned))
+                self._assigned = owned
+
+    def _deadline_loop(self, q):
+        while True:
+            time.sleep(min(lease_retry_period, 1.0))
+            self._publish(q, None)
+
+    def run(self, q):
+        '''Publie un événement SHARD dans la queue de handle_events à chaque
+           changement des namespaces attribués au réplica.'''
+        threading.Thread(target=self._deadline_loop, args=(q,), name='shard-deadline', daemon=True).start()
+        while True:
+            renewed = False
+            try:
+                self.renew()
+                renewed = True
+                ring = HashRing(self.members() | {self.identity}, shard_vnodes)
+                owned = frozenset(namespace for namespace in self.namespaces() if ring.owner(namespace) == self.identity)
+            except (ApiException, urllib3.exceptions.HTTPError, OSError) as e:
+                logging.warning(f"Shard membership {lease_namespace}/{self.lease_name}: {e}")
+                owned = None
+            except Exception:
+                logging.exception(f"Shard membership {lease_namespace}/{self.lease_name}: error")
+                owned = None
+
+            self._publish(q, owned, renewed)
+            time.sleep(lease_retry_period)
+
+
+def _start_sharding(q):
+    '''Lance les Watchers des namespaces déjà attribués (restaurés depuis le
+       snapshot) et le ShardManager, dans le processus de handle_events.'''
+    global shard_queue
+    shard_queue = q
+    for namespace in shard_namespaces:
+        _start_shard_watchers(namespace)
+    shard_size.set(len(shard_namespaces))
+    threading.Thread(target=ShardManager(leader_identity).run, args=(q,), name='sharding', daemon=True).start()
+
+
+def _start_shard_watchers(namespace):
+    stop = shard_watchers[namespace] = threading.Event()
+    for target, args in _namespaced_watchers(namespace):
+        threading.Thread(target=target, args=(shard_queue,) + args, kwargs={'stop': stop},
+                         name=f"watch-{namespace}", daemon=True).start()
+
+
+def _reshard(namespaces, lame_svc, versions, work, critical_svc, synced, sources, relisting, pending):
+    '''Applique une nouvelle attribution de namespaces (appelée avec
+       "state_lock" verrouillé). Les objets d'un namespace perdu sont retirés
+       des caches sans réconciliation: c'est désormais à un autre réplica
+       d'agir. Les Watchers d'un nouveau namespace commencent par un LIST
+       qui suspend les réconciliations jusqu'à son SYNCED.'''
+    global shard_namespaces
+    for namespace in shard_namespaces - namespaces:
+        shard_watchers.pop(namespace).set()
+        for kind in _namespaced_kinds():
+            source = (kind, namespace)
+            synced.discard(source)
+            relisting.pop(source, None)
+            for obj in caches[kind].list(namespace):
+                _handle_event(WatchEvent('DELETED', kind, namespace, obj), work, critical_svc,
+                              synced, sources, relisting, pending)
+            sources.discard(source)
+            versions.pop(source, None)
+            resume_versions.pop(source, None)
+        lame_svc[:] = [key for key in lame_svc if key.split('/', 1)[0] != namespace]
+    lame_services.set(len(lame_svc))
+
+    for namespace in namespaces - shard_namespaces:
+        sources.update((kind, namespace) for kind in _namespaced_kinds())
+        _start_shard_watchers(namespace)
+    shard_namespaces = set(namespaces)
+    shard_size.set(len(shard_namespaces))
+
+
+def _in_shard(namespace):
+    return shard_namespaces is None or namespace in shard_namespaces
+
+
+class WorkQueue:
+    '''File de travail partagée par les workers de réconciliation. Ses clés
+       (namespace/nom d'un Service) sont dédoublonnées: une clé déjà en
+       attente n'est pas ajoutée une seconde fois. Une clé n'est disponible
+       qu'après la fenêtre "delay" qui suit son premier ajout, ce qui regroupe
+       une rafale d'événements en une seule réconciliation.
+       Une clé n'est confiée qu'à un seul worker à la fois: si elle est
+       ajoutée pendant son traitement, elle est remise en attente lorsque
+       le worker appelle done(). Une clé dont le traitement a échoué est
+       reprise après un délai qui double à chaque échec consécutif.'''
+
+    def __init__(self, delay, retry_delay=1.0, retry_max_delay=60.0):
+        self._delay = delay
+        self._retry_delay = retry_delay
+        self._retry_max_delay = retry_max_delay
+        self._due = {}           # {clé: instant à partir duquel la clé est disponible}
+        self._heap = []          # [(instant, clé)], les entrées périmées sont ignorées
+        self._processing = set() # clés en cours de traitement
+        self._dirty = set()      # clés ajoutées pendant leur traitement
+        self._failures = {}      # {clé: nombre d'échecs consécutifs}
+        self._cond = threading.Condition()
+
+    def _schedule(self, key, delay=None):
+        due = time.monotonic() + (self._delay if delay is None else delay)
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+        self._cond.notify()
+
+    def add(self, key):
+        with self._cond:
+            if key in self._processing:
+                self._dirty.add(key)
+            elif key not in self._due:
+                self._schedule(key)
+
+    def _try_get(self):
+        '''Retourne (clé disponible, None) ou bien (None, délai d'attente
+           de la prochaine clé ou None si la file est vide).'''
+        # Ecarte les entrées du tas qui ne correspondent plus à une clé en attente
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None, None
+        due, key = self._heap[0]
+        timeout = due - time.monotonic()
+        if timeout > 0:
+            return None, timeout
+        heapq.heappop(self._heap)
+        del self._due[key]
+        self._processing.add(key)
+        return key, None
+
+    def get(self):
+        '''Attend qu'une clé soit disponible, la marque "en cours" et la retourne.'''
+        with self._cond:
+            while True:
+                key, timeout = self._try_get()
+                if key is not None:
+                    return key
+                self._cond.wait(timeout)
+
+    def done(self, key, failed=False):
+        '''Termine le traitement de la clé et la remet en attente si elle a été
+           ajoutée entre temps ou si son traitement a échoué.'''
+        with self._cond:
+            self._processing.discard(key)
+            if failed:
+                failures = self._failures[key] = self._failures.get(key, 0) + 1
+                self._dirty.discard(key)
+                self._schedule(key, max(self._delay, min(self._retry_delay * 2 ** (failures - 1), self._retry_max_delay)))
+                return
+            self._failures.pop(key, None)
+            if key in self._dirty:
+                self._dirty.discard(key)
+                self._schedule(key)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._due)
+
+
+class AsyncWorkQueue(WorkQueue):
+    '''Variante de la WorkQueue pour le mode asyncio: les workers sont des
+       tâches de la boucle d'événements et attendent les clés avec get_async().
+       Doit être créée depuis la boucle d'événements.'''
+
+    def __init__(self, delay, **kwargs):
+        super().__init__(delay, **kwargs)
+        self._event = asyncio.Event()
+
+    def _schedule(self, key, delay=None):
+        super()._schedule(key, delay)
+        self._event.set()
+
+    async def get_async(self):
+        while True:
+            with self._cond:
+                key, timeout = self._try_get()
+            if key is not None:
+                return key
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def _reconcile_worker(work, lame_svc, critical_svc):
+    '''Boucle d'un worker: réconcilie les Services confiés par la file de travail.'''
+    while True:
+        key = work.get()
+        start = time.monotonic()
+        failed = False
+        sampled = profile_sample and random.random() < profile_sample
+        try:
+            with span('reconcile', **_dequeue_trace(key)):
+                _profiled(sampled, _reconcile_svc, key, lame_svc, critical_svc)
+        except Exception:
+            logging.exception(f"Reconcile error for {key}, retrying later")
+            failed = True
+        finally:
+            work.done(key, failed)
+            reconcile_duration.observe(time.monotonic() - start)
+            queue_depth.labels('work').set(len(work))
+
+
+def watch_pod_template(q):
+    '''Surveille le seul POD Template utilisé pour créer les POD par défaut.'''
+    list_func, keep, kwargs = _list_source('PodTemplate', pod_template_ns)
+    _list_and_watch(q, 'PodTemplate', list_func, keep, **kwargs)
+
+
+def _initial_state():
+    '''Services bancals et CriticalServices restaurés depuis le snapshot (ou
+       vides). Les jauges sont positionnées ici, dans le processus qui tient
+       l'état, et non dans le processus principal qui lit le snapshot.'''
+    lame_svc, critical_svc = restored if restored is not None else ([], CriticalServiceIndex())
+    lame_services.set(len(lame_svc))
+    critical_services.set(len(critical_svc))
+    return lame_svc, critical_svc
 
 
 def handle_events(q):
     '''
-    Boucle de gestion des événements publiés par les Watchers.
-    Il ya 3 types d'évts: les Services, les POD et les CriticalServices
+    Boucle de gestion des événements publiés par les Watchers: Services,
+    POD (ou EndpointSlices), POD du contrôleur, CriticalServices et POD
+    Template, ainsi que les événements LEADING (élection) et SHARD
+    (répartition des namespaces).
+    Les événements mettent à jour les caches locaux puis placent les
+    Services concernés dans une file de travail; chaque Service est
+    ensuite réconcilié une seule fois par fenêtre de "debounce" par l'un
+    des "reconcile_workers" threads. Les clés d'un namespace ne sont
+    placées dans la file qu'une fois ses caches, ceux des CriticalServices
+    et du POD Template synchronisés (voir _enqueue_synced); la recherche
+    des POD orphelins attend que tous les caches le soient.
     '''
-    lame_svc = []       # liste des Services bancals
-    critical_svc = {}   # dict des CriticalServices
+    # Services bancals (namespace/nom) et CriticalServices, éventuellement restaurés
+    lame_svc, critical_svc = _initial_state()
+    sources = _sync_sources()
+    synced = set(resume_versions) & sources  # (type d'objet, namespace) dont le cache est amorcé
+    versions = dict(resume_versions)         # {(type d'objet, namespace): resourceVersion traité}
+    relisting = {}      # {(type d'objet, namespace): clés reçues depuis le début du LIST en cours}
+    pending = deque()   # événements DELETED déduits d'un nouveau LIST
+    work = WorkQueue(debounce_delay, write_retry_delay, reconcile_retry_max_delay)
+    _start_leader_election(q)
+    _start_snapshots(lame_svc, critical_svc, versions, relisting)
+    _start_resync(q, critical_svc, synced, sources, relisting)
+    _start_cache_reports()
+
+    for i in range(reconcile_workers):
+        threading.Thread(target=_reconcile_worker, args=(work, lame_svc, critical_svc),
+                         name=f"reconcile-{i}", daemon=True).start()
+    _start_reconciles(work, critical_svc, synced, sources)
 
     while True:
         event = q.get()
+        if trace_enabled:
+            _trace_id.set(_new_trace_id())
+        with span('event', kind=event.kind, type=event.type,
+                  object=f"{event.obj.namespace}/{event.obj.name}" if isinstance(event.obj, (ObjectRecord, PodRecord)) else None), state_lock:
+            if event.type == 'SHARD':
+                _reshard(event.obj, lame_svc, versions, work, critical_svc, synced, sources, relisting, pending)
+            else:
+                _handle_event(event, work, critical_svc, synced, sources, relisting, pending)
+            while pending:
+                _handle_event(pending.popleft(), work, critical_svc, synced, sources, relisting, pending)
+            if event.resource_version is not None:
+                versions[(event.kind, event.scope)] = event.resource_version
+        queue_depth.labels('events').set(q.qsize())
+        queue_depth.labels('work').set(len(work))
 
-        # Evénement pour les CriticalServices
-        if not hasattr(event['object'], 'kind'):
-            metadata = event['object']['metadata']
-            spec = event['object']['spec']
 
-            if event['object']['kind'] != 'CriticalService':
-                continue
+async def handle_events_async(aq):
+    '''Equivalent de handle_events pour le mode asyncio: les événements sont
+       lus dans une asyncio.Queue et les Services sont réconciliés par des
+       tâches de la boucle d'événements.'''
+    lame_svc, critical_svc = _initial_state()
+    sources = _sync_sources()
+    synced = set(resume_versions) & sources
+    versions = dict(resume_versions)
+    relisting = {}
+    pending = deque()
+    work = AsyncWorkQueue(debounce_delay, retry_delay=write_retry_delay, retry_max_delay=reconcile_retry_max_delay)
+    loop_queue = _LoopQueue(asyncio.get_event_loop(), aq)
+    _start_leader_election(loop_queue)
+    _start_snapshots(lame_svc, critical_svc, versions, relisting)
+    _start_resync(loop_queue, critical_svc, synced, sources, relisting)
+    _start_cache_reports()
 
-            # Mémorise le CriticalService ou bien le met à jour ou le détruit
-            if event['type'] == 'DELETED':
-                if metadata['name'] in critical_svc:
-                    _delete_critical_svc(metadata['name'], spec)
-                    del critical_svc[metadata['name']]
-            else: # ADDED ou MODIFIED
-                critical_svc[metadata['name']] = spec 
-                _check_critical_svc(metadata['name'], spec)
-            continue
-
-        metadata = event['object'].metadata
-        spec = event['object'].spec
-
-        # Evénément pour les Services
-        if event['object'].kind == 'Service':
-            # Ignore les Services de type ExternalName ou ceux qui n'ont pas de 
-            # "selector" comme l'API-Server ou ceux qui sont en cours de suppression
-            selector = spec.selector
-            if selector is None or spec.type == 'ExternalName' or event['type'] == 'DELETED':
-                logging.debug(f"Skip Service {metadata.name}")
-
-                # Détruit le POD par défaut si nécessaire
-                if _is_critical_svc(metadata, critical_svc):
-                    _delete_default_pod(event['object'])
-                continue
+    for i in range(reconcile_workers):
+        asyncio.ensure_future(_reconcile_worker_async(work, lame_svc, critical_svc))
+    _start_reconciles(work, critical_svc, synced, sources)
 
-            # Cherche les POD correspondant au "selector"
-            selectors = [f"{k}={v}" for k, v in spec.selector.items()]
-            pods = v1.list_namespaced_pod(metadata.namespace, watch=False, label_selector=','.join(selectors))
-            if not len(pods.items):
-                if metadata.name not in lame_svc:
-                    logging.warning(f"Service {metadata.name} from Namespace {metadata.namespace} has no selected POD")
-                    lame_svc.append(metadata.name)
-                    logging.info(f"Lame Services={lame_svc}")
+    while True:
+        event = await aq.get()
+        if trace_enabled:
+            _trace_id.set(_new_trace_id())
+        with span('event', kind=event.kind, type=event.type,
+                  object=f"{event.obj.namespace}/{event.obj.name}" if isinstance(event.obj, (ObjectRecord, PodRecord)) else None), state_lock:
+            if event.type == 'SHARD':
+                _reshard(event.obj, lame_svc, versions, work, critical_svc, synced, sources, relisting, pending)
+            else:
+                _handle_event(event, work, critical_svc, synced, sources, relisting, pending)
+            while pending:
+                _handle_event(pending.popleft(), work, critical_svc, synced, sources, relisting, pending)
+            if event.resource_version is not None:
+                versions[(event.kind, event.scope)] = event.resource_version
+        queue_depth.labels('events').set(aq.qsize())
+        queue_depth.labels('work').set(len(work))
 
-                    # Crée le POD par défaut si nécessaire
-                    if _is_critical_svc(metadata, critical_svc):
-                        _create_default_pod(event['objet'])
 
-        # Evénement pour les POD
-        elif event['object'].kind == 'Pod':
-            if event['type'] == 'ADDED' or event['type'] == 'MODIFIED':
-                _check_all_svc(lame_svc, critical_svc, metadata.namespace, event['type'])
-            elif event['type'] == 'DELETED':
-                _check_all_svc(lame_svc, critical_svc, metadata.namespace, event['type'])
+async def _reconcile_worker_async(work, lame_svc, critical_svc):
+    '''Tâche de réconciliation du mode asyncio: la décision est prise dans la
+       boucle d'événements, les appels (bloquants) à l'API-Server sont
+       exécutés dans le pool de threads de la boucle.'''
+    loop = asyncio.get_event_loop()
+    while True:
+        key = await work.get_async()
+        start = time.monotonic()
+        failed = False
+        sampled = profile_sample and random.random() < profile_sample
+        try:
+            with span('reconcile', **_dequeue_trace(key)):
+                trace_id = _trace_id.get()
+                with span('decide', key=key), state_lock:
+                    plan = _profiled(sampled, _reconcile_plan, key, lame_svc, critical_svc)
+                if plan is not None:
+                    await loop.run_in_executor(None, _profiled, sampled, _run_plan, trace_id, plan)
+        except Exception:
+            logging.exception(f"Reconcile error for {key}, retrying later")
+            failed = True
+        finally:
+            work.done(key, failed)
+            reconcile_duration.observe(time.monotonic() - start)
+            queue_depth.labels('work').set(len(work))
 
 
-def _check_all_svc(lame_svc, critical_svc, pod_namespace, pod_event_type):
-    '''
-    Fonction appelée quand un événement sur un POD est survenu.
-    Il faut vérifier si l'ajout, la modification ou la destruction
-    du POD (donné par pod_event_type) a rendu un Service bancal
-    ou non dans le namespace indiqué.
-    La liste des Services bancals est alors mise à jour.
-    Si le Service est dans la liste des CriticalServices, il faut
-    aussi gérer le POD par défaut.
-    '''
-    services = v1.list_namespaced_service(pod_namespace, watch=False)
-    for svc in services.items:
-        metadata = svc.metadata
-        spec = svc.spec
-
-        if len(ns) and not metadata.namespace in ns:
-            continue
-
-        selector = spec.selector
-        if selector is None or spec.type == 'ExternalName':
-            logging.debug(f"Skip Service {metadata.name}")
-            continue
-
-        # Cherche les POD correspondant au "selector"
-        selectors = [f"{k}={v}" for k, v in spec.selector.items()]
-        pods = v1.list_namespaced_pod(pod_namespace, watch=False, label_selector=','.join(selectors))
-
-        # Crée un POD par défaut si le Service devient bancal
-        if not len(pods.items) and (pod_event_type == 'DELETED' or pod_event_type == 'MODIFIED'):
-            if metadata.name not in lame_svc:
-                logging.warning(f"Service {metadata.name} from Namespace {metadata.namespace} has no selected POD")
-                lame_svc.append(metadata.name)
-                logging.info(f"Lame Services={lame_svc}")
-                if _is_critical_svc(metadata, critical_svc):
-                    _create_default_pod(svc)
-
-        # Détruit le POD par défaut si le nombre de POD est > 1 sinon on risque de détruire le POD par défaut !
-        if len(pods.items) and pod_event_type == 'ADDED':
-            if metadata.name in lame_svc:
-                logging.warning(f"Service {metadata.name} from Namespace {metadata.namespace} now has {len(pods.items)} selected POD(s)")
-                lame_svc.remove(metadata.name)
-                logging.info(f"Lame Services={lame_svc}")
-            if len(pods.items) > 1 and _is_critical_svc(metadata, critical_svc):
-                _delete_default_pod(svc)
-
-
-def _is_critical_svc(svc_metadata, critical_svc):
+def _start_reconciles(work, critical_svc, synced, sources):
+    '''Si le snapshot a amorcé tous les caches, aucun SYNCED ne viendra
+       déclencher la première réconciliation de tous les Services.'''
+    if synced == sources:
+        with state_lock:
+            _enqueue_synced(work, _all_keys(critical_svc), critical_svc, synced, sources)
+
+
+GLOBAL_KINDS = ('CriticalService', 'PodTemplate')  # objets surveillés une seule fois pour tout le réplica
+
+
+def _sync_sources():
+    '''Chaque Watch (un par type d'objet et par namespace surveillé) doit
+       terminer son LIST initial avant les premières réconciliations.'''
+    sources = {('CriticalService', None), ('PodTemplate', pod_template_ns)}
+    sources.update((kind, scope) for kind in _namespaced_kinds() for scope in _watch_scopes())
+    return sources
+
+
+def _namespaced_kinds():
+    '''Types d'objets surveillés par namespace (voir _namespaced_watchers).'''
+    return ('Service', 'OwnedPod', 'EndpointSlice' if lame_detection == 'endpointslices' else 'Pod')
+
+
+def _handle_event(event, work, critical_svc, synced, sources, relisting, pending):
+    '''Met à jour les caches avec l'événement et place les Services concernés
+       dans la file de travail (appelée avec "state_lock" verrouillé).'''
+    kind = event.kind
+    source = (kind, event.scope)
+
+    # Le réplica vient d'être élu: les actions écartées tant qu'il était
+    # en attente sont rattrapées en réconciliant tous les Services
+    if event.type == 'LEADING':
+        _enqueue_synced(work, _all_keys(critical_svc), critical_svc, synced, sources)
+        return
+
+    # Evénement d'un Watcher arrêté, pour un namespace qui n'est plus attribué au réplica
+    if sharding and source not in sources:
+        return
+
+    # Début d'un LIST: on note les objets reçus pour retrouver ensuite ceux
+    # qui ont disparu pendant l'interruption du Watch
+    if event.type == 'RELIST':
+        relisting[source] = set()
+        return
+
+    # Fin d'un LIST: les objets du cache absents du LIST ont été détruits.
+    # Les Services du namespace (de tout le cluster pour un Watch global, les
+    # CriticalServices ou le POD Template) sont réconciliés dès que tous les
+    # caches dont ils dépendent sont amorcés
+    if event.type == 'SYNCED':
+        seen = relisting.pop(source, None)
+        if seen is not None:
+            pending.extend(_stale_events(kind, event.scope, seen, critical_svc))
+        logging.info(f"{kind} cache synced" + (f" for Namespace {event.scope}" if event.scope else ""))
+        if source not in synced:
+            synced.add(source)
+            if kind in GLOBAL_KINDS or event.scope is None:
+                keys = _all_keys(critical_svc)
+            else:
+                keys = _all_keys(critical_svc, event.scope) + [GC_KEY]
+            _enqueue_synced(work, keys, critical_svc, synced, sources)
+        return
+
+    # Pendant un LIST, un objet inchangé depuis la dernière version connue est ignoré
+    obj = event.obj
+    if source in relisting and _is_unchanged(kind, obj, critical_svc, relisting[source]):
+        return
+    keys = []
+
+    # Evénement pour les CriticalServices
+    if kind == 'CriticalService':
+        # Mémorise le CriticalService ou bien le met à jour ou le détruit. Les Services
+        # concernés par l'ancienne et la nouvelle définition sont réconciliés
+        # Un CriticalService invalide est ignoré, comme s'il avait été détruit
+        old_spec = critical_svc.get(obj.name)
+        if old_spec is not None:
+            keys += _critical_svc_keys(obj.name, old_spec)
+        error = _critical_spec_error(obj.spec) if event.type != 'DELETED' else None
+        if error:
+            logging.error(f"CriticalService {obj.name} ignored: {error}")
+        if event.type == 'DELETED' or error:
+            critical_svc.pop(obj.name)
+        else: # ADDED ou MODIFIED
+            critical_svc.set(obj.name, obj.spec)
+            keys += _critical_svc_keys(obj.name, obj.spec)
+        keys.append(POOL_KEY_PREFIX + obj.name)
+        critical_services.set(len(critical_svc))
+
+    # Evénément pour les Services
+    elif kind == 'Service':
+        if event.type == 'DELETED':
+            old = svc_cache.delete(obj.namespace, obj.name)
+            svc_labels.update(old, None)
+            svc_index.remove_service(obj.namespace, obj.name)
+        else:
+            old = svc_cache.upsert(obj)
+            svc_labels.update(old, obj)
+            # Les POD du namespace ne sont recomptés que si le "selector" ou le type change
+            if old is None or old.selector != obj.selector or old.svc_type != obj.svc_type:
+                svc_index.add_service(obj, pod_cache.list(obj.namespace))
+        keys.append(f"{obj.namespace}/{obj.name}")
+
+    # Evénement pour les POD: seuls les Services sélectionnés par l'ancienne
+    # ou la nouvelle version du POD sont concernés
+    elif kind == 'Pod':
+        if event.type == 'DELETED':
+            old = pod_cache.delete(obj.namespace, obj.name)
+            new = None
+        else:
+            old = pod_cache.upsert(obj)
+            new = obj
+        # Un POD par défaut d'une version précédente n'est pas compté: il est adopté
+        old_labels = (old.labels or {}) if old is not None and not old.owned else None
+        new_labels = (new.labels or {}) if new is not None and not new.owned else None
+
+        for name in svc_index.update_pod(obj.namespace, old_labels, new_labels):
+            keys.append(f"{obj.namespace}/{name}")
+        if new is not None and new.owned:
+            keys.append(f"{ADOPT_KEY_PREFIX}{obj.namespace}/{obj.name}")
+
+    # Evénement pour les POD du contrôleur: tient à jour le registre des POD
+    # par défaut et les pools; leur Service, leur pool et la recherche des
+    # orphelins sont réconciliés
+    elif kind == 'OwnedPod':
+        if event.type == 'DELETED':
+            old = owned_cache.delete(obj.namespace, obj.name)
+            new = None
+        else:
+            old = owned_cache.upsert(obj)
+            new = obj
+
+        for pool in warm_pools.update(old, new):
+            keys.append(POOL_KEY_PREFIX + pool)
+        _update_default_pods(old, new)
+        for pod in (old, new):
+            if pod is not None and pod.service:
+                keys.append(f"{pod.namespace}/{pod.service}")
+        keys.append(GC_KEY)
+
+    # Evénement pour les EndpointSlices: seuls les Services auxquels
+    # l'ancienne ou la nouvelle version est rattachée sont concernés
+    elif kind == 'EndpointSlice':
+        if event.type == 'DELETED':
+            old = slice_cache.delete(obj.namespace, obj.name)
+            new = None
+        else:
+            old = slice_cache.upsert(obj)
+            new = obj
+
+        for name in endpoint_index.update(old, new):
+            keys.append(f"{obj.namespace}/{name}")
+
+    # Evénement pour le POD Template des POD par défaut
+    elif kind == 'PodTemplate':
+        if event.type == 'DELETED':
+            template_cache.delete(obj.namespace, obj.name)
+        else:
+            template_cache.upsert(obj)
+
+    _enqueue_synced(work, keys, critical_svc, synced, sources)
+
+
+def _key_namespace(key, critical_svc):
+    '''Namespace d'une clé de la file de travail; None pour la recherche des
+       orphelins et les pools sans CriticalService, qui concernent tout le cluster.'''
+    if key == GC_KEY:
+        return None
+    if key.startswith(POOL_KEY_PREFIX):
+        spec = critical_svc.get(key[len(POOL_KEY_PREFIX):])
+        return spec['namespace'] if spec is not None else None
+    if key.startswith(ADOPT_KEY_PREFIX):
+        key = key[len(ADOPT_KEY_PREFIX):]
+    return key.split('/', 1)[0]
+
+
+def _enqueue_synced(work, keys, critical_svc, synced, sources):
+    '''Place dans la file de travail les clés dont les caches sont amorcés:
+       ceux des CriticalServices, du POD Template et des Watch de leur
+       namespace (ou de tout le cluster). Un namespace qui vient d'être
+       attribué au réplica ne retarde donc pas les autres.'''
+    if len(synced) == len(sources):  # "synced" est inclus dans "sources"
+        for key in keys:
+            _enqueue(work, key)
+        return
+    waiting = sources - synced
+    blocked = set()  # namespaces dont un cache n'est pas amorcé
+    for kind, scope in waiting:
+        if kind in GLOBAL_KINDS or scope is None:
+            return
+        blocked.add(scope)
+    for key in keys:
+        namespace = _key_namespace(key, critical_svc)
+        if namespace is not None and namespace not in blocked:
+            _enqueue(work, key)
+
+
+def _all_keys(critical_svc, namespace=None):
+    '''Clés de tous les Services du cache (et de ceux qui ont encore un POD
+       par défaut), de tous les pools et de la recherche des orphelins; ou
+       bien celles des seuls Services et pools du namespace indiqué.'''
+    keys = set(f"{svc.namespace}/{svc.name}" for svc in svc_cache.list(namespace))
+    keys.update(f"{ns}/{name}" for ns, name in default_pods if namespace in (None, ns))
+    # POD par défaut des versions précédentes à adopter: sans Watch des POD, ils sont
+    # cherchés sous le nom qu'ils avaient, pour les Services critiques sans POD par défaut
+    if lame_detection == 'endpointslices':
+        keys.update(f"{ADOPT_KEY_PREFIX}{svc.namespace}/{pod_name_prefix}-{svc.name}" for svc in svc_cache.list(namespace)
+                    if (svc.namespace, svc.name) not in default_pods and critical_svc.matching(svc))
+    else:
+        keys.update(f"{ADOPT_KEY_PREFIX}{pod.namespace}/{pod.name}" for pod in pod_cache.list(namespace) if pod.owned)
+    if namespace is not None:
+        pools = set(name for name, spec in critical_svc.items() if spec['namespace'] == namespace)
+        return list(keys) + [POOL_KEY_PREFIX + pool for pool in pools]
+    pools = set(name for name, spec in critical_svc.items()) | set(warm_pools.names())
+    return list(keys) + [POOL_KEY_PREFIX + pool for pool in pools] + [GC_KEY]
+
+
+def _update_default_pods(old, new):
+    '''Tient à jour le POD par défaut de chaque Service (POD qui portent l'annotation SERVICE_ANNOTATION).'''
+    if old is not None and old.service and default_pods.get((old.namespace, old.service)) == old.name:
+        del default_pods[(old.namespace, old.service)]
+    if new is not None and new.service:
+        default_pods[(new.namespace, new.service)] = new.name
+
+
+def _is_unchanged(kind, obj, critical_svc, seen):
+    '''Note dans "seen" la réception de l'objet pendant un LIST et indique
+       s'il est identique à la version du cache.'''
+    seen.add((obj.namespace, obj.name))
+    if kind == 'CriticalService':
+        return critical_svc.get(obj.name) == obj.spec
+    cached = caches[kind].get(obj.namespace, obj.name)
+    return cached is not None and cached.resource_version == obj.resource_version
+
+
+def _stale_events(kind, namespace, seen, critical_svc):
+    '''Construit les événements DELETED des objets du cache (limités au
+       namespace surveillé s'il est indiqué) qui n'ont pas été reçus
+       pendant le dernier LIST.'''
+    if kind == 'CriticalService':
+        stale = [ObjectRecord(None, name, None, spec=spec)
+                 for name, spec in critical_svc.items() if (None, name) not in seen]
+    else:
+        stale = [obj for obj in caches[kind].list(namespace) if (obj.namespace, obj.name) not in seen]
+    return [WatchEvent('DELETED', kind, namespace, obj) for obj in stale]
+
+
+def _reconcile_svc(key, lame_svc, critical_svc):
     '''
-    retourne un booléen qui indique si le service décrit pas svc_metadata
-    est un CriticalService défini dans critical_svc.
+    Réconcilie le Service "key" (namespace/nom) à partir des caches:
+    le Service est bancal si aucun POD, hormis le POD par défaut, ne
+    correspond à son "selector". La liste des Services bancals est mise
+    à jour et le POD par défaut ne doit exister que si le Service est
+    à la fois bancal et un CriticalService.
+    Une clé "pool:<CriticalService>" réconcilie le pool de POD de réserve.
     '''
-    if svc_metadata.name not in critical_svc:
-        return False
+    with span('decide', key=key), state_lock:
+        plan = _reconcile_plan(key, lame_svc, critical_svc)
 
-    return svc_metadata.namespace == critical_svc[svc_metadata.name]['namespace']
-       
+    # Les appels à l'API-Server sont faits sans verrou
+    if plan is not None:
+        _run_plan(_trace_id.get(), plan)
 
-def _check_critical_svc(svc_name, spec):
-    '''Le CriticalService dont le nom est "svc_name" et la spécification est "spec"
-       a été créé ou modifié: il faut vérifier si cela impacte un Service déjà 
-       existant. '''
-    logging.info(f"Check CriticalService {svc_name} impact")
 
-    # Cherche les Services correspondant à la définition du CriticalService
-    services = v1.list_namespaced_service(spec['namespace'], watch=False)
-    for svc in services.items:
-        if _svc_matches_critical_svc(svc, spec):
-            logging.info(f"Service {svc.metadata.namespace}/{svc.metadata.name} matches !")
+def _reconcile_plan(key, lame_svc, critical_svc):
+    '''Prend la décision de réconciliation de la clé et retourne l'appel à faire
+       ensuite hors verrou, (fonction, arguments...), ou None (appelée avec
+       "state_lock" verrouillé).'''
+    if key == GC_KEY:
+        orphans = _orphan_pods()
+        return (_delete_orphans, orphans) if orphans else None
 
-            # Cherche les POD correspondant au "selector"
-            selectors = [f"{k}={v}" for k, v in svc.spec.selector.items()]
-            pods = v1.list_namespaced_pod(spec['namespace'], watch=False, label_selector=','.join(selectors))
-            if not len(pods.items): 
-                _create_default_pod(svc)
+    if key.startswith(ADOPT_KEY_PREFIX):
+        namespace, name = key[len(ADOPT_KEY_PREFIX):].split('/', 1)
+        return (_adopt_pod, namespace, name)
 
+    if key.startswith(POOL_KEY_PREFIX):
+        pool = key[len(POOL_KEY_PREFIX):]
+        creates, deletes = _pool_decision(pool, critical_svc)
+        return (_apply_pool_actions, pool, creates, deletes) if creates or deletes else None
 
-def _delete_critical_svc(svc_name, spec):
-    '''Le CriticalService dont le nom est "svc_name" et la spécification est "spec"
-       a été détruit: il faut vérifier si cela impacte un Service déjà existant
-       en détruisant un POD par défaut.'''
-    logging.info(f"Delete CriticalService {svc_name} impact")
+    namespace, name = key.split('/', 1)
+    svc, action, pod_name = _reconcile_decision(namespace, name, lame_svc, critical_svc)
+    return (_apply_action, svc, action, namespace, name, pod_name) if action is not None else None
 
-    # Cherche les Services correspondant à la définition du CriticalService
-    services = v1.list_namespaced_service(spec['namespace'], watch=False)
-    for svc in services.items:
-        if _svc_matches_critical_svc(svc, spec):
-            logging.info(f"Service {svc.metadata.namespace}/{svc.metadata.name} matches !")
-            _delete_default_pod(svc)
 
+def _apply_action(svc, action, namespace, name, pod_name=None):
+    # Les réplicas en attente tiennent leur état à jour mais n'agissent pas
+    if action is not None and not leading.is_set():
+        logging.info(f"Standby replica: skip {action} of the default POD for Service {namespace}/{name}")
+        if action == 'create' and pod_name is not None:
+            with state_lock:
+                warm_pools.release(namespace, pod_name)
+        return
+    if action == 'create':
+        # Un POD de réserve est promu s'il y en a un, sinon un POD est créé
+        if pod_name is None or not _promote_pool_pod(svc, pod_name):
+            _create_default_pod(svc)
+    elif action == 'delete':
+        _delete_default_pod(namespace, name, pod_name)
 
-def _svc_matches_critical_svc(svc, spec):
-    '''Détermine si le Service défini par "svc" correspond
-       au CriticalService défini par "spec".'''
 
-    # Compare les Labels du Service avec les matchLabels du CriticalService
-    for matchLabel in spec['matchLabels']:
-        if svc.metadata.labels is None:
-            return False
-        if matchLabel['key'] not in svc.metadata.labels:
-            return False
-        if matchLabel['value'] != svc.metadata.labels[matchLabel['key']]:
-            return False
+def _reconcile_decision(namespace, name, lame_svc, critical_svc):
+    '''Met à jour la liste des Services bancals et retourne le Service (du cache),
+       l'action à mener sur son POD par défaut ('create', 'delete' ou None) et
+       le POD concerné: POD de réserve à promouvoir (réservé dans son pool)
+       ou POD par défaut à détruire (appelée avec "state_lock" verrouillé).'''
+    key = f"{namespace}/{name}"
+    svc = svc_cache.get(namespace, name)
+    default_pod = owned_cache.get(namespace, default_pods.get((namespace, name)))
+    default_pod_name = default_pod.name if default_pod is not None else None
 
-    return True
+    # Ignore les Services de type ExternalName ou ceux qui n'ont pas de 
+    # "selector" comme l'API-Server ou ceux qui ont été supprimés
+    if svc is None or not svc.selector or svc.svc_type == 'ExternalName':
+        logging.debug(f"Skip Service {key}")
+        if key in lame_svc:
+            lame_svc.remove(key)
+            lame_services.set(len(lame_svc))
+        return svc, ('delete' if default_pod is not None else None), default_pod_name
 
+    # Compte les POD correspondant au "selector" (ou les endpoints prêts
+    # du Service), sans le POD par défaut: les POD du contrôleur sont
+    # absents du cache des POD
+    if lame_detection == 'endpointslices':
+        nb_pods = endpoint_index.count(namespace, name, default_pod_name)
+    else:
+        nb_pods = svc_index.count(namespace, name)
+
+    if not nb_pods:
+        if key not in lame_svc:
+            logging.warning(f"Service {name} from Namespace {namespace} has no selected POD")
+            lame_svc.append(key)
+            logging.info(f"Lame Services={lame_svc}")
+    elif key in lame_svc:
+        logging.warning(f"Service {name} from Namespace {namespace} now has {nb_pods} selected POD(s)")
+        lame_svc.remove(key)
+        logging.info(f"Lame Services={lame_svc}")
+
+    lame_services.set(len(lame_svc))
+
+    # Crée ou détruit le POD par défaut si nécessaire
+    pools = critical_svc.matching(svc) if not nb_pods else ()
+    if pools and default_pod is None:
+        standby = warm_pools.claim(pools, namespace) if leading.is_set() else None
+        return svc, 'create', standby
+    if not pools and default_pod is not None:
+        return svc, 'delete', default_pod_name
+    return svc, None, None
+
+
+def _pool_decision(pool, critical_svc):
+    '''Retourne les POD de réserve à créer et à détruire, [(namespace, nom)],
+       pour que le pool compte "warmPool" POD libres dans le namespace du
+       CriticalService (appelée avec "state_lock" verrouillé).'''
+    spec = critical_svc.get(pool)
+    size = int(spec.get('warmPool') or 0) if spec is not None else 0
+    namespace = spec['namespace'] if spec is not None else None
+    # Le pool d'un namespace attribué à un autre réplica est géré par celui-ci
+    if namespace is not None and not _in_shard(namespace):
+        return [], []
+
+    idle = warm_pools.idle(pool)
+    keep = sorted((pod for pod in idle if pod.namespace == namespace),
+                  key=lambda pod: (not pod.ready, pod.phase != 'Running', pod.name))[:size]
+    deletes = [(pod.namespace, pod.name) for pod in idle if pod not in keep]
+
+    # Les noms sont pris dans une suite fixe: un POD déjà créé mais pas encore
+    # reçu par le Watch est recréé sous le même nom, ce que refuse l'API-Server
+    creates = []
+    i = 0
+    while len(keep) + len(creates) < size:
+        name = f"{pod_name_prefix}-pool-{pool}-{i}"
+        if owned_cache.get(namespace, name) is None:
+            creates.append((namespace, name))
+        i += 1
+    return creates, deletes
+
+
+def _orphan_pods():
+    '''POD du contrôleur qui ne sont ni dans un pool ni le POD par défaut
+       enregistré de leur Service: restes d'un arrêt brutal ou d'une course
+       entre deux créations (appelée avec "state_lock" verrouillé).'''
+    return [(pod.namespace, pod.name) for pod in owned_cache.list()
+            if POOL_LABEL not in (pod.labels or {})
+            and not (pod.service and default_pods.get((pod.namespace, pod.service)) == pod.name)]
 
-def _create_default_pod(svc):
-    '''Pour créer un POD, nous devons déjà récupérer le POD Template, puis nous donnerons
-       au POD, les labels attendus par le Service ainsi qu'une Annotation
-       qui nous permettra de le repérer plus facilement.''' 
-    metadata = svc.metadata
-    logging.info(f"Create Default POD from POD Template {pod_template} for Service {metadata.namespace}/{metadata.name}")
 
-    resp = None
+def _adopt_pod(namespace, name):
+    '''Adopte le POD par défaut "name" créé par une version précédente du
+       contrôleur: le label OWNED_LABEL le fait passer dans le registre des
+       POD du contrôleur et SERVICE_ANNOTATION, déduite de son nom, en fait
+       le POD par défaut de son Service. Il est ensuite gardé ou détruit comme
+       tout POD par défaut; sans Service, c'est un orphelin.'''
+    if not leading.is_set():
+        logging.info(f"Standby replica: skip the adoption of POD {namespace}/{name}")
+        return
     try:
-        resp = v1.read_namespaced_pod_template(name=pod_template, namespace=pod_template_ns)
+        resp = _api_call('get', v1.read_namespaced_pod, name=name, namespace=namespace, _preload_content=False)
     except ApiException as e:
-        logging.error("read_namespaced_pod_template error: %s" % e)
+        if e.status != 404:
+            raise
+        return
+    metadata = json_loads(resp.data)['metadata']
+    annotations = metadata.get('annotations') or {}
+    if annotations.get('service-watcher') != 'owned' or OWNED_LABEL in (metadata.get('labels') or {}):
         return
 
-    # Création de la Spec du POD à lancer
+    body = {'metadata': {'labels': {OWNED_LABEL: 'true'}, 'annotations': {}}}
+    prefix = pod_name_prefix + '-'
+    if SERVICE_ANNOTATION not in annotations and name.startswith(prefix):
+        body['metadata']['annotations'][SERVICE_ANNOTATION] = name[len(prefix):]
+    logging.warning(f"Adopt default POD {namespace}/{name} created by a previous version")
+    _write_call('patch', v1.patch_namespaced_pod, name=name, namespace=namespace, body=body)
+
+
+def _delete_orphans(orphans):
+    if not leading.is_set():
+        logging.info(f"Standby replica: skip the deletion of {len(orphans)} orphan POD(s)")
+        return
+    for namespace, name in orphans:
+        logging.warning(f"Delete orphan POD {namespace}/{name}")
+        _delete_pod(namespace, name)
+
+
+def _apply_pool_actions(pool, creates, deletes):
+    if not leading.is_set():
+        logging.info(f"Standby replica: skip the refill of the warm pool {pool}")
+        return
+    for namespace, name in creates:
+        _create_pool_pod(namespace, pool, name)
+    for namespace, name in deletes:
+        _delete_pod(namespace, name)
+
+
+def _critical_svc_keys(svc_name, spec):
+    '''Le CriticalService dont le nom est "svc_name" et la spécification est "spec"
+       a été créé, modifié ou détruit: retourne les clés des Services déjà
+       existants (dans le cache) qui sont impactés. Seuls les Services qui
+       portent ce nom ou tous les matchLabels sont retrouvés, via les index.'''
+    logging.info(f"Check CriticalService {svc_name} impact")
+
+    namespace = spec['namespace']
+    names = set()
+    if svc_cache.get(namespace, svc_name) is not None:
+        names.add(svc_name)
+    required = _compile_match_labels(spec)
+    if required == {}:
+        names.update(svc.name for svc in svc_cache.list(namespace))
+    elif required is not None:
+        names |= svc_labels.find(namespace, required)
+
+    for name in names:
+        logging.info(f"Service {namespace}/{name} matches !")
+    return [f"{namespace}/{name}" for name in names]
+
+
+def _pod_template_spec():
+    '''Le POD Template est lu dans le cache tenu à jour par watch_pod_template;
+       il n'est demandé à l'API-Server que s'il n'est pas (encore) connu.
+       Une erreur de lecture est levée: la réconciliation sera reprise.'''
+    with span('template') as fields:
+        template = template_cache.get(pod_template_ns, pod_template)
+        fields['cached'] = template is not None
+        if template is not None:
+            return template.spec
+        resp = _api_call('get', v1.read_namespaced_pod_template, name=pod_template, namespace=pod_template_ns)
+        return resp.template.spec
+
+
+def _create_default_pod(svc):
+    '''Pour créer un POD, nous devons déjà récupérer le POD Template, puis nous donnerons
+       au POD, les labels attendus par le Service ainsi que des Annotations
+       qui nous permettront de le repérer plus facilement.'''
+    logging.info(f"Create Default POD from POD Template {pod_template} for Service {svc.namespace}/{svc.name}")
+    with span('create_default_pod', service=f"{svc.namespace}/{svc.name}") as fields:
+        # Création de la Spec du POD à lancer
+        pod_manifest = {
+            'apiVersion': 'v1',
+            'kind': 'Pod',
+            'metadata': {
+                'namespace': svc.namespace,
+                'name': pod_name_prefix + '-' + svc.name,
+                'labels': dict(svc.selector, **{OWNED_LABEL: 'true'}),
+                'annotations': { 'service-watcher': 'owned', SERVICE_ANNOTATION: svc.name },
+            },
+            'spec': _pod_template_spec()
+        }
+
+        try:
+            _write_call('create', v1.create_namespaced_pod, body=pod_manifest, namespace=svc.namespace)
+            default_pods_created.inc()
+            fields['created'] = True
+            logging.info("POD created")
+        except ApiException as e:
+            if not _already_exists(e):
+                raise
+            logging.info("POD already exists")
+
+
+def _promote_pool_pod(svc, pod_name):
+    '''Donne au POD de réserve "pod_name" les labels du Service et l'annotation
+       qui en fait son POD par défaut; il quitte ainsi son pool.
+       Retourne False si le POD n'a pas pu être modifié.'''
+    logging.info(f"Promote warm pool POD {pod_name} for Service {svc.namespace}/{svc.name}")
+
+    body = {
+        'metadata': {
+            'labels': dict(svc.selector, **{POOL_LABEL: None}),
+            'annotations': { SERVICE_ANNOTATION: svc.name },
+        }
+    }
+    try:
+        _write_call('patch', v1.patch_namespaced_pod, name=pod_name, namespace=svc.namespace, body=body)
+    except (ApiException, urllib3.exceptions.HTTPError, OSError) as e:
+        logging.error("patch_namespaced_pod error: %s" % e)
+        with state_lock:
+            warm_pools.release(svc.namespace, pod_name)
+        return False
+
+    # Le POD est le POD par défaut du Service sans attendre l'événement du Watch
+    with state_lock:
+        default_pods[(svc.namespace, svc.name)] = pod_name
+    default_pods_promoted.inc()
+    return True
+
+
+def _create_pool_pod(namespace, pool, name):
+    '''Crée un POD de réserve du pool "pool": il ne porte que le label du pool,
+       aucun Service ne le sélectionne.'''
+    logging.info(f"Create warm pool POD {namespace}/{name} for CriticalService {pool}")
+
     pod_manifest = {
         'apiVersion': 'v1',
         'kind': 'Pod',
         'metadata': {
-            'namespace': metadata.namespace,
-            'name': pod_name_prefix + '-' + metadata.name,
-            'labels': svc.spec.selector,
+            'namespace': namespace,
+            'name': name,
+            'labels': { POOL_LABEL: pool, OWNED_LABEL: 'true' },
             'annotations': { 'service-watcher': 'owned' },
         },
-        'spec': resp.template.spec
+        'spec': _pod_template_spec()
     }
 
     try:
-        resp = v1.create_namespaced_pod(body=pod_manifest, namespace=metadata.namespace)
-        logging.info("POD created")
+        _write_call('create', v1.create_namespaced_pod, body=pod_manifest, namespace=namespace)
     except ApiException as e:
-        logging.error("create_namespaced_pod error: %s" % e)
+        if not _already_exists(e):
+            raise
 
 
-def _delete_default_pod(svc):
-    '''Soit un Service est détruit, soit un POD a été modifié: il faut vérifier
-       si le Service defini par "metadata" possède un POD par défaut.
-       Si tel est le cas, il faut le détruire.'''
-    metadata = svc.metadata
-    logging.info(f"Delete Default POD for Service {metadata.namespace}/{metadata.name}")
+def _delete_default_pod(namespace, svc_name, pod_name):
+    '''Soit un Service est détruit, soit il n'est plus bancal ou plus critique:
+       son POD par défaut doit être détruit.'''
+    logging.info(f"Delete Default POD {pod_name} for Service {namespace}/{svc_name}")
+    with span('delete_default_pod', service=f"{namespace}/{svc_name}", pod=pod_name) as fields:
+        fields['deleted'] = _delete_pod(namespace, pod_name)
+    if fields['deleted']:
+        default_pods_deleted.inc()
 
-    resp = None
+
+def _delete_pod(namespace, name):
+    '''Détruit un POD du contrôleur que son registre connaît encore; retourne
+       False si le POD a disparu entre temps (rien à faire).'''
+    with state_lock:
+        if owned_cache.get(namespace, name) is None:
+            logging.info(f"POD {namespace}/{name} already gone")
+            return False
     try:
-        # On essaye toujours la destruction...
-        resp = v1.delete_namespaced_pod(name=pod_name_prefix + '-' + metadata.name, namespace=metadata.namespace)
+        _write_call('delete', v1.delete_namespaced_pod, name=name, namespace=namespace)
         logging.info("POD deleted")
+        return True
     except ApiException as e:
-        logging.error("delete_namespaced_pod error: %s" % e)
+        if e.status != 404:
+            raise
+        return False
+
+
+SNAPSHOT_GLOBALS = ('svc_cache', 'pod_cache', 'template_cache', 'slice_cache', 'owned_cache', 'svc_index',
+                    'svc_labels', 'endpoint_index', 'warm_pools', 'default_pods')
+
+
+def _snapshot_config():
+    '''Paramètres dont dépend le contenu des caches: un snapshot écrit avec
+       d'autres valeurs est ignoré.'''
+    return (sorted(ns), namespaced_watches, sharding, pod_label_selector, pod_field_selector, svc_label_selector,
+            svc_field_selector, lame_detection, endpointslice_version, pod_name_prefix, pod_template,
+            pod_template_ns)
+
+
+def _dump_state(lame_svc, critical_svc, versions):
+    '''Etat à sauvegarder (appelée avec "state_lock" verrouillé): les caches
+       sont copiés, leurs objets n'étant jamais modifiés, et ne seront
+       sérialisés qu'après le verrou; le reste (index, Services bancals et
+       CriticalServices, à l'échelle des Services) est sérialisé tout de suite.'''
+    stores = {name: globals()[name].copy() for name in SNAPSHOT_GLOBALS if isinstance(globals()[name], Store)}
+    state = {
+        'lame_svc': list(lame_svc),
+        'critical_svc': critical_svc,
+        'globals': {name: globals()[name] for name in SNAPSHOT_GLOBALS if name not in stores},
+    }
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'config': _snapshot_config(),
+        'versions': dict(versions),
+        'stores': stores,
+        'state': pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL),
+    }
+
+
+def _save_snapshot(state):
+    '''Ecrit le snapshot (état retourné par _dump_state, sérialisé et
+       compressé sans "state_lock") de façon atomique: le fichier est écrit
+       à côté puis renommé.'''
+    data = zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), 1)
+    tmp = snapshot_file + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, snapshot_file)
+    return len(data)
+
+
+def _snapshot_loop(lame_svc, critical_svc, versions, relisting):
+    saved = None
+    while True:
+        time.sleep(snapshot_interval)
+        try:
+            with state_lock:
+                # Pendant un LIST, les caches et les resourceVersions ne sont pas cohérents
+                if relisting or versions == saved:
+                    continue
+                current = dict(versions)
+                data = _dump_state(lame_svc, critical_svc, versions)
+            size = _save_snapshot(data)
+            saved = current
+            logging.info(f"Snapshot written to {snapshot_file} ({size} bytes)")
+        except Exception:
+            logging.exception(f"Cannot write snapshot {snapshot_file}")
+
+
+def _cached_objects(kind, scope, critical_svc):
+    '''Objets du cache "kind" (limités au namespace "scope" s'il est indiqué), par (namespace, nom).'''
+    if kind == 'CriticalService':
+        return {(None, name): ObjectRecord(None, name, None, spec=spec) for name, spec in critical_svc.items()}
+    return {(obj.namespace, obj.name): obj for obj in caches[kind].list(scope)}
+
+
+def _version(kind, obj):
+    '''Version d'un objet du cache: les CriticalServices sont comparés par leur spec.'''
+    if obj is None:
+        return None
+    return obj.spec if kind == 'CriticalService' else obj.resource_version
+
+
+def _resync_diff(kind, scope, critical_svc):
+    '''Compare le cache "kind" du namespace "scope" avec un LIST paginé et
+       retourne les écarts: {(namespace, nom): ((version du cache, version du
+       LIST), événement qui corrige le cache)}.'''
+    with state_lock:
+        cached = _cached_objects(kind, scope, critical_svc)
+
+    list_func, keep, kwargs = _list_source(kind, scope)
+    drifts = {}
+    for page in _list_pages(list_func, **kwargs):
+        for obj in page['items'] or ():
+            if keep is not None and not keep(obj):
+                continue
+            record = _record(kind, obj)
+            key = (record.namespace, record.name)
+            old = cached.pop(key, None)
+            if _version(kind, old) != _version(kind, record):
+                drifts[key] = ((_version(kind, old), _version(kind, record)),
+                               WatchEvent('ADDED' if old is None else 'MODIFIED', kind, scope, record))
+    # Les objets du cache absents du LIST ont été détruits
+    for key, old in cached.items():
+        drifts[key] = ((_version(kind, old), None), WatchEvent('DELETED', kind, scope, old))
+    return drifts
+
+
+def _resync_loop(q, critical_svc, synced, sources, relisting):
+    '''Resynchronise périodiquement les caches amorcés avec l'API-Server.
+       Le LIST et les Watch ne sont pas ordonnés: un écart peut venir d'un
+       événement pas encore reçu (ou d'un LIST antérieur à un événement
+       reçu). Un écart n'est donc corrigé, par un événement publié dans la
+       queue de handle_events, que s'il est retrouvé à l'identique par la
+       resynchronisation suivante. Seuls les Services concernés par les
+       objets corrigés sont réconciliés.'''
+    candidates = {}
+    while True:
+        time.sleep(resync_period)
+        with state_lock:
+            todo = [source for source in sources if source in synced and source not in relisting]
+        drifts = {}
+        for kind, scope in todo:
+            try:
+                for key, drift in _resync_diff(kind, scope, critical_svc).items():
+                    drifts[(kind, scope) + key] = drift
+            except (ApiException, urllib3.exceptions.HTTPError, OSError) as e:
+                logging.warning(f"{kind}: resync failed ({e})")
+
+        for key, (versions, event) in drifts.items():
+            if candidates.get(key) == versions:
+                logging.warning(f"{event.kind} {event.obj.namespace or ''}/{event.obj.name} out of sync "
+                                f"(cached {versions[0]!r}, listed {versions[1]!r}), resynced")
+                resync_drifts.labels(event.kind).inc()
+                q.put(event)
+        candidates = {key: versions for key, (versions, event) in drifts.items() if candidates.get(key) != versions}
+        logging.info(f"Resync: {len(todo)} source(s), {len(candidates)} drift(s) to confirm")
+
+
+def _cache_report_loop():
+    while True:
+        time.sleep(cache_report_interval)
+        # Les caches sont copiés sous verrou, puis mesurés sans bloquer handle_events
+        with state_lock:
+            copies = {kind: cache.copy() for kind, cache in caches.items()}
+        sizes = {kind: (len(cache), cache.footprint()) for kind, cache in copies.items()}
+        for kind, (count, size) in sizes.items():
+            cache_objects.labels(kind).set(count)
+            cache_bytes.labels(kind).set(size)
+        logging.info("Caches: " + ", ".join(f"{kind} {count} objects/{size} bytes"
+                                            for kind, (count, size) in sizes.items()))
+
+
+def _start_cache_reports():
+    if cache_report_interval:
+        threading.Thread(target=_cache_report_loop, name='cache-report', daemon=True).start()
+
+
+def _start_resync(q, critical_svc, synced, sources, relisting):
+    if resync_period:
+        threading.Thread(target=_resync_loop, args=(q, critical_svc, synced, sources, relisting),
+                         name='resync', daemon=True).start()
+
+
+def _start_snapshots(lame_svc, critical_svc, versions, relisting):
+    if snapshot_file:
+        threading.Thread(target=_snapshot_loop, args=(lame_svc, critical_svc, versions, relisting),
+                         name='snapshot', daemon=True).start()
+
+
+def _load_snapshot():
+    '''Restaure les caches, les index et l'état de handle_events depuis le
+       snapshot, et indique aux Watchers à partir de quel resourceVersion
+       reprendre. Un Watch dont le resourceVersion a expiré (410) refait un
+       LIST qui élimine les objets disparus entre temps.'''
+    global resume_versions, restored, caches, shard_namespaces
+    if not snapshot_file or not os.path.exists(snapshot_file):
+        return
+    try:
+        with open(snapshot_file, 'rb') as f:
+            state = pickle.loads(zlib.decompress(f.read()))
+    except Exception as e:
+        logging.error(f"Cannot read snapshot {snapshot_file}: {e}")
+        return
+    if state.get('format') != SNAPSHOT_FORMAT or state.get('config') != _snapshot_config():
+        logging.warning(f"Snapshot {snapshot_file} ignored: written with another format or configuration")
+        return
+
+    globals().update(state['stores'])
+    state.update(pickle.loads(state['state']))
+    globals().update(state['globals'])
+    caches = {'Service': svc_cache, 'Pod': pod_cache, 'PodTemplate': template_cache, 'EndpointSlice': slice_cache,
+              'OwnedPod': owned_cache}
+    resume_versions = state['versions']
+    restored = (state['lame_svc'], state['critical_svc'])
+    if sharding:
+        # Les namespaces du snapshot restent attribués jusqu'au premier événement SHARD
+        shard_namespaces = set(scope for kind, scope in resume_versions if kind in _namespaced_kinds())
+    logging.warning(f"State restored from snapshot {snapshot_file}, {len(resume_versions)} watch(es) resumed")
+
+
+def _api_client(maxsize):
+    '''Crée un client de l'API (configuration chargée par main()) avec son
+       propre pool de "maxsize" connexions HTTP.'''
+    configuration = Configuration()
+    configuration.connection_pool_maxsize = maxsize
+    api_client = client.ApiClient(configuration)
+
+    # Keep-alive TCP: une connexion coupée sans préavis (équilibreur de
+    # charge, API-Server redémarré) est détectée au lieu de bloquer un Watch
+    if api_keepalive:
+        options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, api_keepalive),
+                        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, api_keepalive // 3)),
+                        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)]
+        api_client.rest_client.pool_manager.connection_pool_kw['socket_options'] = options
+    return api_client
+
+
+def _init_clients():
+    '''Crée les clients de l'API du processus: les connexions héritées d'un
+       autre processus ne sont jamais réutilisées.'''
+    global v1, watch_v1, custom_api, coordination_api
+    watch_client = _api_client(watch_pool_size or (32 if sharding else len(_watchers())))
+    api_client = _api_client(api_pool_size)
+    watch_v1 = client.CoreV1Api(watch_client)
+    custom_api = client.CustomObjectsApi(watch_client)
+    v1 = client.CoreV1Api(api_client)
+    coordination_api = client.CoordinationV1Api(api_client)
+
+
+def _process_main(target, q, *args):
+    '''Point d'entrée des processus du mode "process".'''
+    _init_clients()
+    target(q, *args)
+
+
+def watch_all(q):
+    '''Mode "process": tous les Watchers tournent dans des threads d'un même
+       processus et partagent son pool de connexions, quel que soit le nombre
+       de namespaces surveillés.'''
+    threads = [threading.Thread(target=target, args=(q,) + args, name=target.__name__, daemon=True)
+               for target, args in _watchers()]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+
+def _namespaced_watchers(scope):
+    '''Watchers d'un namespace (ou de tout le cluster si "scope" vaut None).'''
+    watchers = [(watch_services, (scope,)), (watch_owned_pods, (scope,))]
+    # Avec les EndpointSlices, les POD ne sont plus comptés: seuls ceux du contrôleur sont surveillés
+    if lame_detection == 'endpointslices':
+        watchers.append((watch_endpoint_slices, (scope,)))
+    else:
+        watchers.append((watch_pods, (scope,)))
+    return watchers
+
+
+class _LoopQueue:
+    '''Permet aux Watchers, exécutés dans des threads en mode asyncio, de
+       publier leurs événements dans l'asyncio.Queue de la boucle.'''
+
+    def __init__(self, loop, aq):
+        self._loop = loop
+        self._aq = aq
+
+    def put(self, item):
+        self._loop.call_soon_threadsafe(self._aq.put_nowait, item)
+
+
+def _watchers():
+    '''Liste des Watchers à lancer: (fonction, arguments après la queue). En
+       mode "sharding", les Watchers des namespaces sont lancés et arrêtés
+       par le processus de handle_events au gré des attributions.'''
+    watchers = []
+    if not sharding:
+        for scope in _watch_scopes():
+            watchers += _namespaced_watchers(scope)
+    watchers.append((watch_critical_services, ()))
+    watchers.append((watch_pod_template, ()))
+    return watchers
+
+
+async def run_asyncio():
+    '''Mode asyncio: un seul processus et une seule boucle d'événements. Le
+       client Kubernetes étant synchrone, chaque Watch s'exécute dans son
+       propre thread et publie ses événements dans la boucle; handle_events
+       et les réconciliations s'exécutent dans la boucle.'''
+    loop = asyncio.get_event_loop()
+    aq = asyncio.Queue()
+    watchers = _watchers()
+    executor = ThreadPoolExecutor(max_workers=len(watchers), thread_name_prefix='watch')
+    futures = [loop.run_in_executor(executor, target, _LoopQueue(loop, aq), *args) for target, args in watchers]
+    await asyncio.gather(handle_events_async(aq), *futures)
+
+
+def main():
+    '''Charge la configuration du cluster (fichier donné sur la ligne de
+       commande, ~/.kube/config ou configuration "in-cluster"), crée les
+       clients de l'API puis lance les Watchers et handle_events.'''
+
+    if len(sys.argv) > 1:
+        config.load_kube_config(sys.argv[1])
+    else:
+        try:
+            config.load_kube_config()
+        except:
+            config.load_incluster_config()
+
+    _load_snapshot()
+
+    if runtime == 'asyncio':
+        _init_clients()
+        if metrics_port:
+            prometheus_client.start_http_server(metrics_port)
+        asyncio.run(run_asyncio())
+    else:
+        q = Queue()
+        procs = [Process(target=_process_main, args=(watch_all, q)),
+                 Process(target=_process_main, args=(handle_events, q))]
+        [p.start() for p in procs]
+
+        # Le processus principal agrège et expose les métriques de tous les processus
+        if metrics_port:
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            prometheus_client.start_http_server(metrics_port, registry=registry)
+        [p.join() for p in procs]
 
 
 # Programme principal !
-q = Queue()
-procs = [
-            Process(target=watch_services, args=(q,)), 
-            Process(target=watch_pods, args=(q,)), 
-            Process(target=watch_critical_services, args=(q,)),
-            Process(target=handle_events, args=(q,)),
-        ]
-[p.start() for p in procs]
-[p.join() for p in procs]
+if __name__ == '__main__':
+    main()